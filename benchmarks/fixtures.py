@@ -0,0 +1,92 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Synthetic repos to benchmark against.
+#
+# A few template repos with random content are generated with `git
+# fast-import`, the benchmark repos are hard linked copies of these, so even
+# 10k repos are created quickly and take little disk space.
+
+import os
+import random
+import shutil
+import subprocess
+
+
+def _fast_import_stream(commits, files, file_size, rng, start=0, parent=None):
+    # random content does not compress, so pack sizes are as configured
+    out = []
+    for i in range(start, start + commits):
+        out.append(b'commit refs/heads/master\n')
+        out.append('committer Bench <bench@example.com> {} +0000\n'.format(1500000000 + i * 60).encode())
+        msg = 'commit {}\n'.format(i).encode()
+        out.append(b'data ' + str(len(msg)).encode() + b'\n' + msg)
+        if i == start and parent is not None:
+            out.append('from {}\n'.format(parent).encode())
+        for j in range(files):
+            content = rng.getrandbits(file_size * 8).to_bytes(file_size, 'little') if file_size else b''
+            out.append('M 100644 inline file{}/{}.bin\n'.format(j % 16, rng.randrange(files * 4)).encode())
+            out.append(b'data ' + str(len(content)).encode() + b'\n' + content + b'\n')
+        out.append(b'\n')
+    return b''.join(out)
+
+
+def create_template(path, commits, files, file_size, seed):
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    stream = _fast_import_stream(commits, files, file_size, random.Random(seed))
+    subprocess.run(['git', '--git-dir', path, 'fast-import', '--quiet'], input=stream, check=True)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def create_repos(base, count, template_dir, commits=10, files=2, file_size=1024, templates=4):
+    """
+    Create `count` bare repos `r<i>.git` in `base`, copied from templates
+    kept in `template_dir`. Returns their paths.
+    """
+    os.makedirs(base, exist_ok=True)
+    os.makedirs(template_dir, exist_ok=True)
+
+    paths = []
+    for t in range(min(templates, count)):
+        path = os.path.join(template_dir, 't{}.git'.format(t))
+        if not os.path.exists(path):
+            create_template(path, commits, files, file_size, seed=t)
+        paths.append(path)
+
+    repos = []
+    for i in range(count):
+        path = os.path.join(base, 'r{}.git'.format(i))
+        if not os.path.exists(path):
+            # git replaces refs and packs instead of changing them, so the
+            # copies can share files
+            shutil.copytree(paths[i % len(paths)], path, copy_function=_link_or_copy)
+        repos.append(path)
+    return repos
+
+
+def add_commits(path, commits=1, files=2, file_size=1024, seed=0):
+    """
+    Add commits on top of the master branch of a repo.
+    """
+    stream = _fast_import_stream(commits, files, file_size, random.Random(seed), start=seed * 1000, parent='refs/heads/master^0')
+    subprocess.run(['git', '--git-dir', path, 'fast-import', '--quiet', '--force'], input=stream, check=True)
@@ -0,0 +1,257 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of repo discovery and backups against local fake servers.
+#
+# For every scale (number of repos) and transport, a fresh set of synthetic
+# repos is served and gickup is run through these stages, each timed as a
+# whole command:
+#
+#   discover     updaterepolist, answering no
+#   init         updaterepolist -y (discovery again, cached, plus init)
+#   full         first dobackup --incremental, fetching everything
+#   incremental  dobackup --incremental after a part of the repos changed
+#
+# Discovery goes through the fake GitHub API for the file, git and http
+# transports, and through `find` over the fake ssh for the ssh transport.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import fixtures
+import servers
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+STAGES = ['discover', 'init', 'full', 'incremental']
+
+
+def get_env():
+    # the fake ssh comes first in PATH, gickup is run from this checkout
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(BENCHMARK_DIR, 'bin') + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env.pop('GITHUB_TOKEN', None)
+    return env
+
+
+def gickup(config, args, stdin=None, verbose=False):
+    l = [sys.executable, '-m', 'gickup', '--config-file', config] + args
+    start = time.monotonic()
+    p = subprocess.run(l, input=stdin, env=get_env(),
+            stdout=None if verbose else subprocess.DEVNULL,
+            stderr=None if verbose else subprocess.PIPE)
+    duration = time.monotonic() - start
+    # failed fetches are part of the result, other failures are not
+    if p.returncode != 0 and args[0] != 'dobackup':
+        raise RuntimeError('{} failed: {}'.format(' '.join(l), (p.stderr or b'').decode(errors='replace')))
+    return duration
+
+
+def read_report(path):
+    with open(path, 'r') as f:
+        repos = json.load(f)['repos']
+    return {
+            'synced': sum(1 for r in repos if r['status'] == 'synced'),
+            'unchanged': sum(1 for r in repos if r['status'] == 'unchanged'),
+            'failed': sum(1 for r in repos if r['status'] == 'failed'),
+            'bytes': sum(r['bytes'] or 0 for r in repos),
+            'objects': sum(r['objects'] or 0 for r in repos),
+        }
+
+
+def run_scale(args, workdir, scale, transport):
+    # generated repos are reused by later runs with the same parameters
+    size = '{}x{}x{}'.format(args.commits, args.files, args.file_size)
+    base = os.path.join(workdir, 'repos-{}-{}'.format(scale, size))
+    srv = os.path.join(base, 'srv')
+
+    print('Creating {} repos'.format(scale))
+    start = time.monotonic()
+    repos = fixtures.create_repos(srv, scale, os.path.join(workdir, 'templates-' + size), commits=args.commits, files=args.files, file_size=args.file_size)
+    generate = time.monotonic() - start
+
+    run_dir = os.path.join(base, transport)
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    config = os.path.join(run_dir, 'config.json')
+
+    users = {}
+    github = servers.GithubServer(users)
+    daemon = None
+    http = None
+    try:
+        if transport == 'git':
+            daemon = servers.GitDaemon(srv)
+            base_url = daemon.url + '/'
+        elif transport == 'http':
+            http = servers.GitHTTPServer(srv)
+            base_url = http.url + '/'
+        else:
+            base_url = 'file://' + srv + '/'
+        users['bench'] = [(os.path.basename(p)[:-len('.git')], base_url + os.path.basename(p)) for p in repos]
+
+        with open(config, 'w') as f:
+            json.dump({'localbasepath': os.path.join(run_dir, 'backup'), 'github_api_url': github.url}, f)
+
+        if transport == 'ssh':
+            index = ['--type', 'ssh', 'localhost:' + srv]
+        else:
+            index = ['--type', 'github', 'bench']
+
+        multiplex = [] if transport == 'ssh' and args.ssh_multiplex else ['--no-ssh-multiplex']
+        jobs = ['--jobs', str(args.jobs)]
+
+        result = {'scale': scale, 'transport': transport, 'jobs': args.jobs, 'generate': generate, 'stages': {}}
+        stages = result['stages']
+
+        print('  discover')
+        stages['discover'] = {'seconds': gickup(config, multiplex + ['updaterepolist'] + index + jobs, stdin=b'n\n', verbose=args.verbose)}
+
+        print('  init')
+        stages['init'] = {'seconds': gickup(config, multiplex + ['-y', 'updaterepolist'] + index + jobs, verbose=args.verbose)}
+
+        print('  full')
+        report = os.path.join(run_dir, 'full.json')
+        stages['full'] = {'seconds': gickup(config, multiplex + ['dobackup', '--incremental', '--report', report] + jobs, verbose=args.verbose)}
+        stages['full'].update(read_report(report))
+
+        rng = random.Random(scale)
+        changed = rng.sample(repos, int(round(len(repos) * args.change_ratio)))
+        for i, p in enumerate(changed):
+            fixtures.add_commits(p, files=args.files, file_size=args.file_size, seed=i + 1)
+
+        print('  incremental ({} changed)'.format(len(changed)))
+        report = os.path.join(run_dir, 'incremental.json')
+        stages['incremental'] = {'seconds': gickup(config, multiplex + ['dobackup', '--incremental', '--report', report] + jobs, verbose=args.verbose)}
+        stages['incremental'].update(read_report(report))
+        stages['incremental']['changed'] = len(changed)
+
+        return result
+
+    finally:
+        github.close()
+        if daemon is not None:
+            daemon.close()
+        if http is not None:
+            http.close()
+        if not args.keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def get_metadata():
+    def output(l):
+        try:
+            return subprocess.check_output(l, cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+            'date': datetime.now().isoformat(),
+            'commit': output(['git', 'rev-parse', 'HEAD']),
+            'git': output(['git', '--version']),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        }
+
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline is not None:
+        for r in baseline['results']:
+            previous[r['scale'], r['transport']] = r['stages']
+
+    print('{:>7} {:>9} {:>12} {:>10} {:>10}'.format('repos', 'transport', 'stage', 'seconds', 'change'))
+    for r in results:
+        for stage in STAGES:
+            seconds = r['stages'][stage]['seconds']
+            change = ''
+            old = previous.get((r['scale'], r['transport']), {}).get(stage)
+            if old is not None and old['seconds'] > 0:
+                change = '{:+.1f}%'.format((seconds / old['seconds'] - 1) * 100)
+            print('{:>7} {:>9} {:>12} {:>10.2f} {:>10}'.format(r['scale'], r['transport'], stage, seconds, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gickup discovery and backups against local fake servers.')
+    parser.add_argument('--scales', default='10,1000', help='Comma separated numbers of repos to benchmark with, e.g. `10,1000,10000`.')
+    parser.add_argument('--transports', type=lambda s: s.split(','), default=['file'], help='Comma separated transports to fetch with: file, git (git daemon), http (smart HTTP) and ssh (fake ssh running commands locally).')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Value of --jobs passed to gickup.')
+    parser.add_argument('--commits', type=int, default=10, help='History depth of the synthetic repos.')
+    parser.add_argument('--files', type=int, default=2, help='Files changed by every commit.')
+    parser.add_argument('--file-size', dest='file_size', type=int, default=1024, help='Size of every changed file in bytes.')
+    parser.add_argument('--change-ratio', dest='change_ratio', type=float, default=0.1, help='Part of the repos that get a new commit before the incremental backup.')
+    parser.add_argument('--ssh-multiplex', dest='ssh_multiplex', action='store_true', help='Let gickup start ssh master connections (to measure their overhead).')
+    parser.add_argument('--workdir', help='Directory for the repos, kept between runs so they are generated only once. A temporary directory by default.')
+    parser.add_argument('--keep', action='store_true', help='Keep the backups and configs of every run in the work directory.')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare with.')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the output of gickup.')
+    args = parser.parse_args()
+
+    for transport in args.transports:
+        if not transport in ['file', 'git', 'http', 'ssh']:
+            parser.error('Unknown transport {}'.format(transport))
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='gickup-bench-')
+    workdir = os.path.abspath(workdir)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    results = []
+    try:
+        for scale in [int(s) for s in args.scales.split(',')]:
+            for transport in args.transports:
+                print('Benchmarking {} repos over {}'.format(scale, transport))
+                results.append(run_scale(args, workdir, scale, transport))
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+            'metadata': get_metadata(),
+            'parameters': {k: getattr(args, k) for k in ['jobs', 'commits', 'files', 'file_size', 'change_ratio', 'ssh_multiplex']},
+            'results': results,
+        }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, sort_keys=True, indent=4)
+            f.write('\n')
+
+    print_results(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
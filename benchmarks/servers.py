@@ -0,0 +1,196 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Local stand-ins for the servers gickup talks to: a git daemon, a smart HTTP
+# git server and the repo listing of the GitHub API.
+
+import os
+import json
+import socket
+import hashlib
+import threading
+import subprocess
+import time
+import urllib.parse
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(object):
+    """
+    Runs an HTTP server in a background thread.
+    """
+
+    def __init__(self, handler):
+        self.port = get_free_port()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', self.port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class GitDaemon(object):
+    """
+    Serves all repos below `base` at git://127.0.0.1:<port>/.
+    """
+
+    def __init__(self, base):
+        self.port = get_free_port()
+        self.process = subprocess.Popen(
+                ['git', 'daemon', '--reuseaddr', '--export-all', '--listen=127.0.0.1',
+                 '--port={}'.format(self.port), '--base-path={}'.format(base), base],
+                stderr=subprocess.DEVNULL)
+        wait_for_port(self.port)
+
+    @property
+    def url(self):
+        return 'git://127.0.0.1:{}'.format(self.port)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def GitHTTPServer(base):
+    """
+    Serve all repos below `base` over smart HTTP, using `git http-backend`.
+    """
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            self.run_backend()
+
+        def do_POST(self):
+            self.run_backend()
+
+        def run_backend(self):
+            path, _, query = self.path.partition('?')
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            env = dict(os.environ,
+                    GIT_PROJECT_ROOT=base,
+                    GIT_HTTP_EXPORT_ALL='1',
+                    REQUEST_METHOD=self.command,
+                    PATH_INFO=urllib.parse.unquote(path),
+                    QUERY_STRING=query,
+                    CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                    CONTENT_LENGTH=str(len(body)),
+                    HTTP_CONTENT_ENCODING=self.headers.get('Content-Encoding', ''),
+                    GIT_PROTOCOL=self.headers.get('Git-Protocol', ''),
+                    REMOTE_ADDR='127.0.0.1')
+            p = subprocess.run(['git', 'http-backend'], input=body, stdout=subprocess.PIPE, env=env)
+
+            head, _, content = p.stdout.partition(b'\r\n\r\n')
+            status = 200
+            headers = []
+            for line in head.decode().split('\r\n'):
+                name, _, value = line.partition(':')
+                if name.lower() == 'status':
+                    status = int(value.split()[0])
+                elif name:
+                    headers.append((name, value.strip()))
+
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return Server(Handler)
+
+
+def GithubServer(users):
+    """
+    Serve `/users/<user>/repos` like the GitHub API, paginated and with
+    ETags. `users` maps user names to lists of `(name, git_url)` tuples, or
+    `(name, git_url, id)` to simulate renamed repos.
+    """
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 3 or parts[0] != 'users' or parts[2] != 'repos' or not parts[1] in users:
+                self.send_error(404)
+                return
+
+            query = urllib.parse.parse_qs(url.query)
+            per_page = min(int(query.get('per_page', ['30'])[0]), 100)
+            page = int(query.get('page', ['1'])[0])
+            repos = users[parts[1]]
+            chunk = repos[(page - 1) * per_page : page * per_page]
+
+            content = json.dumps([{
+                    'id': r[2] if len(r) > 2 else zlib.crc32(r[1].encode()),
+                    'name': r[0],
+                    'git_url': r[1],
+                } for r in chunk]).encode()
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', etag)
+            if page * per_page < len(repos):
+                self.send_header('Link', '<{}/users/{}/repos?per_page={}&page={}>; rel="next"'.format(
+                        self.server_url, parts[1], per_page, page + 1))
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = Server(Handler)
+    Handler.server_url = server.url
+    return server
@@ -0,0 +1,113 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the startup time of single gickup invocations with a large
+# config, as run by scripts.
+#
+# A registry with many repos is created, one of which is a real repo. Every
+# command is run repeatedly and the median wall time is reported, next to the
+# time of starting a bare Python interpreter.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import tempfile
+import subprocess
+
+import fixtures
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+sys.path.insert(0, REPO_DIR)
+from gickup import registry
+
+
+def create_config(workdir, count):
+    srv = os.path.join(workdir, 'srv')
+    fixtures.create_repos(srv, 1, os.path.join(workdir, 'templates'), commits=2, files=1, file_size=64)
+
+    config = os.path.join(workdir, 'config.json')
+    with open(config, 'w') as f:
+        json.dump({'localbasepath': os.path.join(workdir, 'backup')}, f)
+
+    backup = os.path.join(workdir, 'backup', 'repo')
+    subprocess.run([sys.executable, '-m', 'gickup', '--config-file', config, 'addrepo', os.path.join(srv, 'r0.git'), backup],
+            env=get_env(), stdout=subprocess.DEVNULL, check=True)
+
+    r = registry.Registry(config + '.db')
+    r.update(('https://example.com/user{}/repo{}.git'.format(i % 1000, i), os.path.join(workdir, 'backup', 'other', str(i))) for i in range(count - 1))
+    r.close()
+    return config, backup
+
+
+def get_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def measure(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run(command, env=get_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of single gickup commands with a large config.')
+    parser.add_argument('--repos', type=int, default=50000, help='Number of repos in the registry.')
+    parser.add_argument('--runs', type=int, default=20, help='Number of runs per command, the median is reported.')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gickup-startup-')
+    try:
+        config, backup = create_config(workdir, args.repos)
+        gickup = [sys.executable, '-m', 'gickup', '--config-file', config]
+
+        commands = [
+                ('python', [sys.executable, '-c', 'pass']),
+                ('import', [sys.executable, '-c', 'import gickup.__main__']),
+                ('help', gickup + ['--help']),
+                ('setpolicy', gickup + ['setpolicy', backup]),
+                ('dobackup', gickup + ['--no-ssh-multiplex', 'dobackup', backup]),
+            ]
+
+        results = {}
+        for name, command in commands:
+            results[name] = measure(command, args.runs)
+            print('{:>10} {:8.1f} ms'.format(name, results[name] * 1000))
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'repos': args.repos, 'runs': args.runs, 'seconds': results}, f, sort_keys=True, indent=4)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
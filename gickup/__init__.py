@@ -15,6 +15,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Gickup. If not, see <http://www.gnu.org/licenses/>.
 
-from . import gblib
-from . import helpers
-from . import repoindex
+import importlib
+
+
+def __getattr__(name):
+    # submodules are imported on first use, so importing the package (and
+    # starting the command line interface) stays fast
+    if name in ('gblib', 'helpers', 'repoindex'):
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -18,16 +18,20 @@
 # along with Gickup. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import copy
 import argparse
-import shutil
-from datetime import datetime
+import time
 
+# Only the modules every command needs are imported here, the others are
+# imported by the commands using them, to keep the startup of single
+# commands fast.
 from . import helpers
 from . import gblib
-from . import repoindex
-
 
 def run_updaterepolist(args, settings):
+    import subprocess
+    from . import policies
+    from . import repoindex
 
     if args.target is None:
         indices = [repoindex.RepoIndex.CreateFromType(*i) for i in settings['repo_indices']]
@@ -38,14 +42,98 @@ def run_updaterepolist(args, settings):
     else:
         indices = [repoindex.RepoIndex.CreateFromType(args.type, args.target)]
 
-    newrepos = {}
+    index_cache_file = helpers.get_state_file_path(args.configfile, 'indexcache')
+    index_cache = helpers.loadstate(index_cache_file, {})
+
+    ttl = settings['index_ttl'] if args.ttl is None else args.ttl
+    now = time.time()
 
+    found = {}
+    scanned = []
     for ri in indices:
+        ri.cache = index_cache.setdefault('{}://{}'.format(ri.uri_type, ri.url), {})
+        ri.timeout = args.timeout
+        if ri.uri_type == 'ssh':
+            ri.max_depth = args.max_depth
+            # listings of a different depth cannot be compared
+            if ri.cache.get('max_depth') != args.max_depth:
+                ri.cache.pop('listing', None)
+            ri.cache['max_depth'] = args.max_depth
+
+        # indices checked recently are not checked again
+        if ttl and ri.cache.get('listing') is not None and now - ri.cache['checked'] < ttl:
+            print('Using listing of {}://{} from {:.0f} minutes ago'.format(ri.uri_type, ri.url, (now - ri.cache['checked']) / 60))
+            found.update(ri.cache['listing'])
+        else:
+            scanned.append(ri)
+
+    ssh_pool = get_ssh_pool(args) if any(ri.uri_type == 'ssh' for ri in scanned) else None
+
+    def get_list(ri):
         print('Checking {}://{}'.format(ri.uri_type, ri.url))
-        newrepos.update(ri.get_list(settings))
+        if ri.uri_type == 'ssh' and ssh_pool is not None:
+            ri.ssh_command = ssh_pool.get_ssh_command(ri.serveraddress)
+        return ri.get_list(settings)
+
+    removed = {}
+    moved = {}
+
+    # scan all indices at the same time, a failing one only results in a
+    # warning
+    try:
+        for ri, repos, exc in helpers.run_parallel(get_list, scanned, args.jobs):
+            if exc is not None:
+                print('Warning: Could not check {}://{}: {}'.format(ri.uri_type, ri.url, exc))
+                continue
+
+            new_since, removed_since, moved_since = repoindex.update_listing(ri, repos, now)
+            print('Found {} repos in {}://{} ({} new, {} removed, {} moved since the last check)'.format(
+                len(repos), ri.uri_type, ri.url, len(new_since), len(removed_since), len(moved_since)))
+            found.update(repos)
+            removed.update(removed_since)
+            moved.update(moved_since)
+    finally:
+        helpers.savestate(index_cache_file, index_cache)
+
+    registry = settings['repos']
+
+    # follow renamed repos, keeping their backups
+    for url, new_url in sorted(moved.items()):
+        if not url in registry:
+            continue
+        if new_url in registry:
+            # backed up already under the new url
+            removed[url] = registry[url]
+            continue
+
+        print('Repo {} moved to {}'.format(url, new_url))
+        path = registry[url]
+        if args.node is not None:
+            from . import sharding
+            path = sharding.get_node_path(settings, args.node, path)
+        try:
+            if os.path.exists(os.path.join(path, 'config')):
+                gblib.Repo(path).set_config('remote.origin.url', new_url)
+                registry.rename(url, new_url)
+            else:
+                # not backed up here (yet), the next backup updates the origin
+                registry.rename(url, new_url)
+                registry.update_meta(new_url, update_origin=True)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            print('Warning: Could not follow {}: {}'.format(url, helpers.format_error(e)))
+
+    # repos gone upstream are not fetched any more, until they come back
+    vanished = set(url for url, path, meta in registry.items_with_meta() if 'vanished' in meta)
+    for url in sorted(vanished & set(found)):
+        print('Repo {} is back'.format(url))
+        registry.update_meta(url, vanished=None)
+    for url in sorted(set(removed) - set(found)):
+        if url in registry and not url in vanished:
+            print('Repo {} was removed, its backup in {} is kept but not updated any more'.format(url, registry[url]))
+            registry.update_meta(url, vanished=now)
 
     # only consider unknown repos
-    newrepos = {url:path for url, path in newrepos.items() if not url in settings['repos']}
+    newrepos = {url:path for url, path in found.items() if not url in registry}
 
 
     if not newrepos:
@@ -65,30 +153,671 @@ def run_updaterepolist(args, settings):
 
     if b:
         print('Saving new repos.')
-        for k, v in newrepos.items():
-            gblib.init_repo(k, v)
+
+        def init(r):
+            gblib.create_bare_repo(*r)
+            if args.pool is not None:
+                join_pool(settings, args.pool, *r)
+
+        # the registry saves every repo right away, so an interrupted run
+        # keeps its progress
+        for (k, v), _, exc in helpers.run_parallel(init, newrepos.items(), args.jobs):
+            if exc is not None:
+                print('Failed to initialize {}: {}'.format(v, exc))
+                continue
+            print(v)
             settings['repos'][k] = v
+            if args.pool is not None:
+                settings['repos'].update_meta(k, pool=get_pool_name(args.pool, k))
+            settings['repos'].update_meta(k, fetch_policy=policies.get_policy_for_url(settings, k))
         helpers.savesettings(args.configfile, settings)
     else:
         print('Not saving new repos.')
 
 
-def run_dobackup(args, settings):
+def get_pool_name(name, url):
+    from . import pools
+
+    if name == 'auto':
+        return pools.get_pool_name(url)
+    return name
+
+
+def join_pool(settings, name, url, path):
+    from . import pools
+
+    name = get_pool_name(name, url)
+    pools.join_pool(gblib.Repo(path, url), pools.get_pool_path(settings, name))
+    return name
+
+
+def get_repos(args, settings):
+    # the repos given by local path on the command line, or all repos (of
+    # this node)
+    node = getattr(args, 'node', None)
+    if node is not None:
+        from . import sharding
+
     if args.localpath:
         paths = [os.path.abspath(os.path.expanduser(p)) for p in args.localpath]
-        repos = [gblib.Repo(p) for p in paths]
+        repos = []
+        for p in paths:
+            urls = settings['repos'].find_by_path(p if node is None else sharding.get_registered_path(settings, node, p))
+            repos.append(gblib.Repo(p, urls[0] if len(urls) == 1 else None))
+        return repos
+    elif node is not None:
+        return [gblib.Repo(v, k) for k,v in sharding.get_node_repos(settings, node)]
     else:
-        repos = [gblib.Repo(v) for v in settings['repos'].values()]
+        return [gblib.Repo(v, k) for k,v in settings['repos'].items()]
+
+
+def get_ssh_pool(args):
+    """
+    Return the pool of ssh connections shared for the whole run, or None
+    with --no-ssh-multiplex. Only commands connecting to servers create it.
+    """
+    if not args.ssh_multiplex:
+        return None
+    if getattr(args, 'ssh_pool', None) is None:
+        import atexit
+        from . import sshmux
+        args.ssh_pool = sshmux.SSHSessionPool()
+        atexit.register(args.ssh_pool.close)
+    return args.ssh_pool
+
+
+def get_repo_backup(args, settings, refstate, quiet):
+    from . import backup
+    from . import throttle
+
+    # common setup of dobackup and daemon
+    limits = dict(settings['throttle'])
+    for k in ['bwlimit', 'host_bwlimit', 'nice', 'ionice', 'slow_host']:
+        if getattr(args, k) is not None:
+            limits[k] = getattr(args, k)
+
+    host_backoff = None
+    if args.backoff or limits['slow_host'] is not None:
+        host_backoff = throttle.HostBackoff(slow=limits['slow_host'])
+
+    rate_limiter = None
+    if limits['bwlimit'] is not None or limits['host_bwlimit'] is not None:
+        import atexit
+        rate_limiter = throttle.RateLimiter(throttle.parse_rate(limits['bwlimit']), throttle.parse_rate(limits['host_bwlimit']))
+        atexit.register(rate_limiter.close)
+
+    return backup.RepoBackup(
+            settings,
+            ssh_pool=get_ssh_pool(args),
+            refstate=refstate,
+            changed_only=args.changed_only or settings['snapshot_mode'] == 'changed',
+            retries=args.retries,
+            quiet=quiet,
+            rate_limiter=rate_limiter,
+            command_prefix=throttle.get_priority_prefix(limits['nice'], limits['ionice']),
+            host_backoff=host_backoff,
+            init_missing=args.node is not None)
+
 
+def run_dobackup(args, settings):
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import datetime
+    from . import backup
+    from . import journal
+    from . import telemetry
+
+    repos = get_repos(args, settings)
+
+    # repos removed upstream (see updaterepolist), unless given explicitly
+    if not args.localpath:
+        vanished = set(url for url, path, meta in settings['repos'].items_with_meta() if 'vanished' in meta)
+        skipped = [r for r in repos if r.url in vanished]
+        if skipped:
+            repos = [r for r in repos if not r.url in vanished]
+            print('Skipping {} repos removed upstream.'.format(len(skipped)))
+
+    # finished repos of full runs are recorded, so an interrupted run can be
+    # resumed
+    run = None
+    run_lock = None
+    if args.localpath:
+        if args.resume:
+            print('Only runs of all repos can be resumed.')
+            exit(1)
+        date = datetime.now()
+    else:
+        journal_file = helpers.get_state_file_path(args.configfile, 'journal', args.node)
+        run_lock = journal.lock(journal_file)
+        if run_lock is None:
+            print('Another backup run is in progress.')
+            exit(1)
+
+        run = journal.RunJournal.load(journal_file)
+        if run is not None and args.resume:
+            print('Resuming run {} of {}, {} repos already done.'.format(run.run_id, run.date, len(run.finished)))
+            repos = [r for r in repos if not r.git_dir in run.finished]
+        elif run is not None and not run.complete and not args.restart:
+            print('Run {} of {} was interrupted. Continue it with `gickup dobackup --resume`, or start a new run with --restart.'.format(run.run_id, run.date))
+            exit(1)
+        else:
+            if args.resume:
+                print('No interrupted run to resume, starting a new one.')
+            run = journal.RunJournal.start(journal_file)
+
+        # use the same timestamp for all repos of this run
+        date = run.date
+
+    # remote branch heads seen at the last fetch of each repo
+    refstate_file = helpers.get_state_file_path(args.configfile, 'refstate', args.node)
+    refstate = helpers.loadstate(refstate_file, {}) if args.incremental else None
+
+    rb = get_repo_backup(args, settings, refstate, quiet=args.jobs > 1)
+
+    report = telemetry.RunReport(time.time())
+    failed = []
+    unchanged = 0
+
+    # maintenance of synced repos runs alongside the remaining fetches
+    maintainer = ThreadPoolExecutor(max_workers=args.maintain_jobs) if args.maintain else None
+    maintenance_futures = []
+
+    try:
+        for repo, record, exc in helpers.run_parallel(lambda r: rb.backup(r, date), repos, args.jobs, key=backup.get_repo_host, key_limit=args.host_jobs):
+            if exc is not None:
+                record = telemetry.FetchRecord(repo.git_dir, repo.url)
+                record.status = 'failed'
+                record.error = helpers.format_error(exc)
+            report.add(record)
+            rb.update_registry(record)
+
+            if record.status == 'failed':
+                print('Failed to sync {}: {}'.format(repo.git_dir, record.error))
+                failed.append((repo, record.error))
+            elif record.status == 'unchanged':
+                unchanged += 1
+
+            if run is not None and record.status != 'failed':
+                run.add(repo.git_dir)
+
+            if maintainer is not None and record.status == 'synced':
+                maintenance_futures.append(maintainer.submit(run_maintenance, repo, settings))
+
+        if maintenance_futures:
+            print('Waiting for maintenance to finish.')
+        for future in maintenance_futures:
+            maintenance_record = future.result()
+            report.add(maintenance_record)
+            finish_maintenance(maintenance_record, settings)
+    finally:
+        if maintainer is not None:
+            maintainer.shutdown(cancel_futures=True)
+        if run is not None:
+            run.close()
+        if run_lock is not None:
+            run_lock.close()
+        if refstate is not None:
+            helpers.savestate(refstate_file, refstate)
+
+        report.duration = time.time() - report.started
+        if args.report is not None:
+            report.write(os.path.expanduser(args.report), args.report_format)
+
+    print('Synced {} of {} repos.'.format(len(repos) - len(failed) - unchanged, len(repos)))
+    if report.maintenance:
+        print_maintenance_summary(report.maintenance)
+    if unchanged:
+        print('Skipped {} unchanged repos.'.format(unchanged))
+    if failed:
+        print('Failed repos:')
+        for repo, error in failed:
+            print('  {}: {}'.format(repo.git_dir, error))
+        if run is not None:
+            run.mark_complete()
+            print('Run `gickup dobackup --resume` to retry them.')
+        exit(1)
+
+    if run is not None:
+        run.remove()
+
+
+def run_maintenance(repo, settings, dry_run=False):
+    import subprocess
+    from . import maintenance
+    from . import telemetry
+
+    try:
+        return maintenance.maintain_repo(repo, dry_run, **settings['maintenance'])
+    except subprocess.CalledProcessError as e:
+        record = telemetry.MaintenanceRecord(repo.git_dir)
+        record.error = helpers.format_error(e)
+        return record
+
+
+def finish_maintenance(record, settings, dry_run=False):
+    # print and save the outcome, in the main thread
+    if record.error is not None:
+        print('Failed to maintain {}: {}'.format(record.path, record.error))
+    elif record.tasks:
+        if dry_run:
+            print('Would run {} on {}'.format(', '.join(record.tasks), record.path))
+        else:
+            print('Ran {} on {} in {:.1f}s, {:.1f} MiB freed'.format(
+                    ', '.join(record.tasks), record.path, record.duration, record.reclaimed / (1 << 20)))
+
+    if not dry_run and record.error is None and record.tasks:
+        for url in settings['repos'].find_by_path(record.path):
+            settings['repos'].update_meta(url, last_maintenance=time.time())
+
+
+def print_maintenance_summary(records):
+    done = [r for r in records if r.tasks and r.error is None]
+    print('Maintained {} repos in {:.1f}s, {:.1f} MiB freed.'.format(
+            len(done),
+            sum(r.duration for r in done),
+            sum(r.reclaimed or 0 for r in done) / (1 << 20)))
+
+
+def run_maintain(args, settings):
+    from . import pools
+    from . import telemetry
+    from . import throttle
+
+    for k in ['max_packs', 'max_loose_objects']:
+        if getattr(args, k) is not None:
+            settings['maintenance'][k] = getattr(args, k)
+
+    repos = get_repos(args, settings)
+    if not args.localpath:
+        repos += [gblib.Repo(p) for p in pools.list_pools(settings)]
+
+    command_prefix = throttle.get_priority_prefix(settings['throttle']['nice'], settings['throttle']['ionice'])
     for repo in repos:
-        print('Syncing {}'.format(repo.git_dir))
-        repo.fetch(
-            refspec='refs/heads/*:refs/heads/backup/{}/*'.format(
-                datetime.now().strftime(settings['dateformat'])
-            ))
+        repo.command_prefix = command_prefix
+
+    records = []
+    for repo, record, exc in helpers.run_parallel(lambda r: run_maintenance(r, settings, args.dry_run), repos, args.jobs):
+        if exc is not None:
+            record = telemetry.MaintenanceRecord(repo.git_dir)
+            record.error = helpers.format_error(exc)
+        finish_maintenance(record, settings, args.dry_run)
+        records.append(record)
+
+    if args.dry_run:
+        print('{} of {} repos need maintenance.'.format(sum(1 for r in records if r.tasks), len(records)))
+    else:
+        print_maintenance_summary(records)
+    if any(r.error is not None for r in records):
+        exit(1)
+
+
+def run_verify(args, settings):
+    from . import pools
+    from . import telemetry
+    from . import verify
+
+    repos = get_repos(args, settings)
+    if not args.localpath:
+        repos += [gblib.Repo(p) for p in pools.list_pools(settings)]
+
+    # verified packs and ref tips of every repo
+    state_file = helpers.get_state_file_path(args.configfile, 'verifystate', args.node)
+    state = helpers.loadstate(state_file, {})
+
+    def check(repo):
+        partial = False
+        if repo.url is not None and repo.url in settings['repos']:
+            policy = settings['repos'].get_meta(repo.url).get('fetch_policy') or {}
+            partial = policy.get('filter') is not None
+        return verify.verify_repo(repo, state.get(repo.git_dir), full=args.full, partial=partial)
+
+    started = time.time()
+    records = []
+    try:
+        for repo, result, exc in helpers.run_parallel(check, repos, args.jobs):
+            if exc is not None:
+                record = telemetry.VerifyRecord(repo.git_dir)
+                record.status = 'error'
+                record.problems = [helpers.format_error(exc)]
+            else:
+                record, repo_state = result
+                if repo_state is not None:
+                    state[repo.git_dir] = repo_state
+            records.append(record)
+
+            if record.status == 'ok':
+                print('Verified {}{}'.format(repo.git_dir, ' (full)' if record.full else ''))
+            else:
+                print('{} {}:'.format('Corrupt' if record.status == 'corrupt' else 'Could not verify', repo.git_dir))
+                for problem in record.problems:
+                    print('  {}'.format(problem))
+
+            for url in settings['repos'].find_by_path(repo.git_dir):
+                settings['repos'].update_meta(url,
+                        last_verify=time.time(),
+                        verify_status=record.status,
+                        verify_problems=record.problems[:10] or None)
+    finally:
+        helpers.savestate(state_file, state)
+
+        if args.report is not None:
+            helpers.savestate(os.path.expanduser(args.report), {
+                    'started': started,
+                    'duration': time.time() - started,
+                    'repos': [r.as_dict() for r in records],
+                })
+
+    bad = [r for r in records if r.status != 'ok']
+    print('Verified {} of {} repos.'.format(len(records) - len(bad), len(records)))
+    if bad:
+        exit(1)
+
+
+def run_daemon(args, settings):
+    import signal
+    from . import daemon
+
+    refstate_file = helpers.get_state_file_path(args.configfile, 'refstate', args.node)
+    refstate = helpers.loadstate(refstate_file, {})
+
+    # keep ssh connections open between the backups of a server
+    ssh_pool = get_ssh_pool(args)
+    if ssh_pool is not None:
+        ssh_pool.persist = max(ssh_pool.persist, 2 * args.min_interval)
+
+    rb = get_repo_backup(args, settings, refstate, quiet=True)
+
+    def select(url, path, meta):
+        # repos removed upstream are not fetched (see updaterepolist)
+        if 'vanished' in meta:
+            return None
+        if args.node is not None:
+            from . import sharding
+            return sharding.select_repo(settings, args.node, url, path, meta)
+        return path
+
+    d = daemon.Daemon(
+            rb, settings['repos'],
+            jobs=args.jobs,
+            host_jobs=args.host_jobs,
+            min_interval=args.min_interval,
+            max_interval=args.max_interval,
+            on_rescan=lambda: helpers.savestate(refstate_file, refstate),
+            debounce=args.debounce,
+            max_debounce=args.max_debounce,
+            select=select)
+
+    server = None
+    if args.listen is not None:
+        from . import webhooks
+        try:
+            address = webhooks.parse_address(args.listen)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        server = webhooks.WebhookServer(address, d.notify, secret=settings['webhook_secret'])
+        if settings['webhook_secret'] is None and not address[0] in ['127.0.0.1', '::1']:
+            print('Warning: no webhook_secret configured, anyone reaching {} can trigger backups.'.format(args.listen))
+        server.start()
+        print('Listening for push notifications on {}:{}.'.format(*server.server_address[:2]))
+
+    def interrupt(signum, frame):
+        print('Waiting for running backups to finish.')
+        # a second interrupt aborts them
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        d.stop()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: d.stop())
+    signal.signal(signal.SIGINT, interrupt)
+
+    print('Starting backup daemon.')
+    try:
+        d.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        helpers.savestate(refstate_file, refstate)
+
+
+def load_snapshot_index(args):
+    from . import snapshots
+
+    repo = gblib.Repo(os.path.abspath(os.path.expanduser(args.localpath)))
+    index = snapshots.SnapshotIndex(repo.git_dir)
+    if not index.exists():
+        print('No snapshot index in {}, run `gickup reindex` to create it.'.format(repo.git_dir))
+        exit(1)
+    return repo, index
+
+
+def run_log(args, settings):
+    from datetime import datetime
+    from . import snapshots
+
+    repo, index = load_snapshot_index(args)
+    try:
+        at, since, until = [None if v is None else snapshots.parse_date(v, settings['dateformat']) for v in [args.at, args.since, args.until]]
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+    if at is not None:
+        if args.branch is not None:
+            sha = index.get_commit(args.branch, at)
+            print(sha or 'Branch {} did not exist at that time.'.format(args.branch))
+        else:
+            for branch, sha in sorted(index.get_state(at).items()):
+                print('{} {}'.format(sha, branch))
+        return
+
+    for t, sha, branch in index.read(since, until):
+        if args.branch is not None and branch != args.branch:
+            continue
+        print('{} {} {}'.format(datetime.fromtimestamp(t), 'deleted ' if sha == snapshots.NULL_SHA else sha[:8], branch))
+
+
+def run_restore(args, settings):
+    import subprocess
+    from . import snapshots
+
+    repo, index = load_snapshot_index(args)
+    try:
+        at = snapshots.parse_date(args.at, settings['dateformat'])
+        snapshots.restore_snapshot(repo, index.get_state(at), os.path.abspath(args.dest), branch=args.branch)
+    except (ValueError, subprocess.CalledProcessError) as e:
+        print('Could not restore: {}'.format(e))
+        exit(1)
+    print('Restored {} as of {} to {}'.format(args.branch or 'all branches', at, args.dest))
+
+
+def run_reindex(args, settings):
+    from . import snapshots
+
+    full = settings['snapshot_mode'] != 'changed'
+
+    def reindex(repo):
+        state = snapshots.rebuild_index(repo, settings['dateformat'], full=full)
+        if full:
+            # changed mode keeps these up to date itself
+            snapshots.update_latest_refs(repo, state)
+        return len(state)
+
+    failed = False
+    for repo, result, exc in helpers.run_parallel(reindex, get_repos(args, settings), args.jobs):
+        if exc is not None:
+            print('Failed to index {}: {}'.format(repo.git_dir, helpers.format_error(exc)))
+            failed = True
+        else:
+            print('Indexed {}, {} branches'.format(repo.git_dir, result))
+
+    if failed:
+        exit(1)
+
+
+def run_prune(args, settings):
+    from datetime import datetime
+    from . import snapshots
+
+    repos = get_repos(args, settings)
+    now = datetime.now()
+
+    retention = dict(settings['retention'])
+    for k in ['hourly_days', 'daily_days', 'monthly_days']:
+        if getattr(args, k) is not None:
+            retention[k] = getattr(args, k)
+
+    def prune(repo):
+        return snapshots.prune_repo(repo, settings['dateformat'], now, dry_run=args.dry_run, **retention)
+
+    failed = False
+    for repo, result, exc in helpers.run_parallel(prune, repos, args.jobs):
+        if exc is not None:
+            print('Failed to prune {}: {}'.format(repo.git_dir, exc))
+            failed = True
+        else:
+            print('{} {} of {} backup refs in {}'.format(
+                'Would delete' if args.dry_run else 'Deleted',
+                result[0], result[1], repo.git_dir))
+
+    if failed:
+        exit(1)
+
+
+def run_export(args, settings):
+    import sys
+    import shutil
+    import tarfile
+    import tempfile
+    from datetime import datetime
+    from . import export
+
+    date = datetime.now()
+    target = os.path.expanduser(args.target)
+
+    # status messages must not end up in a tar stream on stdout
+    out = sys.stderr if args.tar and args.target == '-' else sys.stdout
+
+    repos = []
+    for repo in get_repos(args, settings):
+        policy = settings['repos'].get_meta(repo.url).get('fetch_policy') if repo.url in settings['repos'] else None
+        if (policy or {}).get('filter') is not None:
+            # bundles would need the objects left out by the filter
+            print('Skipping partial backup {}'.format(repo.git_dir), file=out)
+        else:
+            repos.append(repo)
+
+    if args.tar:
+        # bundles are built in parallel and added to the tar one by one
+        staging = tempfile.mkdtemp(prefix='gickup-export-')
+        tar_file = sys.stdout.buffer if args.target == '-' else open(target, 'wb')
+        tar = tarfile.open(fileobj=tar_file, mode='w|')
+
+    def build(repo):
+        git_dir = repo.git_dir
+        if args.node is not None:
+            from . import sharding
+            git_dir = sharding.get_registered_path(settings, args.node, git_dir)
+        path = export.get_export_path(settings['localbasepath'], git_dir)
+        result = export.create_export(repo, os.path.join(staging if args.tar else target, path), date, repo.url)
+        if result is not None and not args.tar:
+            export.finish_export(result)
+        return path, result
+
+    exported = []
+    failed = False
+    try:
+        for repo, result, exc in helpers.run_parallel(build, repos, args.jobs):
+            if exc is not None:
+                print('Failed to export {}: {}'.format(repo.git_dir, helpers.format_error(exc)), file=out)
+                failed = True
+                continue
+
+            path, e = result
+            if e is None:
+                print('Unchanged {}'.format(repo.git_dir), file=out)
+                continue
+
+            if args.tar:
+                for name in e.files:
+                    tar.add(os.path.join(e.directory, name), arcname=os.path.join(path, name))
+                    os.remove(os.path.join(e.directory, name))
+            exported.append(e)
+            print('Exported {} ({})'.format(repo.git_dir, ', '.join(e.files)), file=out)
+
+        if args.tar:
+            tar.close()
+            tar_file.flush()
+            # only now the next exports can be based on these
+            for e in exported:
+                export.finish_export(e)
+
+    finally:
+        if args.tar:
+            if tar_file is not sys.stdout.buffer:
+                tar_file.close()
+            shutil.rmtree(staging, ignore_errors=True)
+
+    print('Exported {} of {} repos.'.format(len(exported), len(repos)), file=out)
+    if failed:
+        exit(1)
+
+
+def run_restorebundles(args, settings):
+    from . import export
+
+    localpath = os.path.abspath(os.path.expanduser(args.localpath))
+    try:
+        manifest = export.restore_repo(os.path.expanduser(args.source), localpath, seq=args.seq, url=args.url)
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+    url = args.url or manifest['url']
+    print('Restored {} as of {}'.format(localpath, manifest['date']))
+
+    if not url in settings['repos']:
+        settings['repos'][url] = localpath
+        print('Added {} to the backup list.'.format(url))
+
+
+def run_rebalance(args, settings):
+    import collections
+    from . import sharding
+
+    nodes = settings['nodes']
+    if not nodes:
+        print('No nodes configured.')
+        exit(1)
+
+    items = settings['repos'].items_with_meta()
+    costs = sharding.get_costs(items)
+    assignment = sharding.plan_assignment(costs, nodes, slack=args.slack)
+
+    moves = collections.Counter()
+    load = collections.Counter()
+    count = collections.Counter()
+    for url, path, meta in items:
+        node = assignment[url]
+        old = sharding.get_assigned_node(url, meta, nodes)
+        if old != node:
+            moves[old, node] += 1
+        load[node] += costs[url]
+        count[node] += 1
+        if not args.dry_run and meta.get('node') != node:
+            settings['repos'].update_meta(url, node=node)
+
+    total = sum(load.values()) or 1
+    for node in sorted(nodes):
+        print('{}: {} repos, {:.0%} of the fetch time'.format(node, count[node], load[node] / total))
+    for (old, node), n in sorted(moves.items()):
+        print('{} {} repos from {} to {}'.format('Would move' if args.dry_run else 'Moved', n, old, node))
+    if moves and not args.dry_run:
+        print('Moved repos are fetched anew by their new node, the old copies can be deleted.')
 
 
 def run_addrepo(args, settings):
+    from . import policies
+
     bpath = args.backuppath
     if bpath is not None:
         bpath = os.path.expanduser(bpath)
@@ -104,18 +833,84 @@ def run_addrepo(args, settings):
     if uri_type == 'file':
         url = os.path.abspath(os.path.expanduser(target))
 
+    policy = get_policy_from_args(args)
+    if policy is None:
+        policy = policies.get_policy_for_url(settings, url)
+
     gblib.init_repo(url, bpath)
 
     settings['repos'][url] = bpath
+    settings['repos'].update_meta(url, fetch_policy=policy)
+    if args.pool is not None:
+        settings['repos'].update_meta(url, pool=join_pool(settings, args.pool, url, bpath))
     helpers.savesettings(args.configfile, settings)
 
 
+def get_policy_from_args(args):
+    from . import policies
+
+    policy = {}
+    for k in policies.POLICY_KEYS:
+        if getattr(args, k) is not None:
+            policy[k] = getattr(args, k)
+    return policies.validate_policy(policy) if policy else None
+
+
+def run_setpolicy(args, settings):
+    policy = None if args.clear else get_policy_from_args(args)
+
+    for repo in get_repos(args, settings):
+        if repo.url is None or not repo.url in settings['repos']:
+            print('Repository {} not configured.'.format(repo.git_dir))
+            continue
+        if not args.clear and policy is None:
+            print('{}: {}'.format(repo.git_dir, settings['repos'].get_meta(repo.url).get('fetch_policy')))
+            continue
+        settings['repos'].update_meta(repo.url, fetch_policy=policy)
+
+
+def run_joinpool(args, settings):
+    import subprocess
+
+    failed = 0
+    for repo in get_repos(args, settings):
+        if repo.url is None or not repo.url in settings['repos']:
+            print('Repository {} not configured.'.format(repo.git_dir))
+            failed += 1
+            continue
+        print('Adding {} to pool'.format(repo.git_dir))
+        try:
+            name = join_pool(settings, args.name, repo.url, repo.git_dir)
+        except subprocess.CalledProcessError as e:
+            print('Failed to add {} to pool: {}'.format(repo.git_dir, helpers.format_error(e)))
+            failed += 1
+            continue
+        settings['repos'].update_meta(repo.url, pool=name)
+
+    if failed:
+        exit(1)
+
+
 def run_setconfig(args, settings):
+    if args.name == 'registry':
+        from . import registry
+
+        old = settings['repos']
+        new = registry.Registry(os.path.expanduser(args.newvalue), settings['registry_journal_mode'])
+        if os.path.abspath(new.path) != os.path.abspath(old.path):
+            if len(new) == 0:
+                print('Copying {} repos from `{}` to `{}`.'.format(len(old), old.path, new.path))
+                new.update_with_meta(old.items_with_meta())
+            elif len(old) > 0:
+                print('Warning: `{}` already holds {} repos, the {} repos of `{}` are not copied.'.format(new.path, len(new), len(old), old.path))
+        new.close()
+
     settings[args.name] = args.newvalue
     helpers.savesettings(args.configfile, settings)
 
 
 def run_addindex(args, settings):
+    from . import repoindex
 
     if args.type == 'auto':
         ri = repoindex.RepoIndex.CreateFromUrl(args.target)
@@ -132,11 +927,13 @@ def run_addindex(args, settings):
 
 
 def run_removerepo(args, settings):
+    import shutil
+
     p = os.path.expanduser(args.backuppath)
     if not os.path.isabs(p):
         p = os.path.join(settings['localbasepath'], p)
     p = os.path.abspath(p)
-    matching_repos = [(k,v) for k,v in settings['repos'].items() if v==p]
+    matching_repos = [(k,p) for k in settings['repos'].find_by_path(p)]
 
     if len(matching_repos) == 0:
         print('Repository {} not configured.'.format(p))
@@ -146,13 +943,13 @@ def run_removerepo(args, settings):
         k,v = matching_repos[0]
 
         del settings['repos'][k]
-        helpers.savesettings(args.configfile, settings)
 
         if args.delete_files:
             shutil.rmtree(p)
 
 
 def run_removeindex(args, settings):
+    from . import repoindex
 
     if args.type == 'auto':
         ri = repoindex.RepoIndex.CreateFromUrl(args.target)
@@ -168,6 +965,34 @@ def run_removeindex(args, settings):
         helpers.savesettings(args.configfile, settings)
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return number
+
+
+def add_throttle_arguments(parser):
+    parser.add_argument('--bwlimit', help='Total download rate limit of all concurrent fetches in bytes per second, e.g. `10M`. Only applies to ssh remotes, fetches over http(s) are not limited.')
+    parser.add_argument('--host-bwlimit', dest='host_bwlimit', help='Download rate limit per host in bytes per second. Only applies to ssh remotes, fetches over http(s) are not limited.')
+    parser.add_argument('--nice', type=int, help='Run git with this nice level.')
+    parser.add_argument('--ionice', help='Run git with this IO scheduling class (see `ionice -c`).')
+    parser.add_argument('--backoff', action='store_true', help='Wait before contacting a host again after it failed, longer after every failure.')
+    parser.add_argument('--slow-host', dest='slow_host', type=float, help='Back off from hosts when a fetch takes longer than this many seconds. Implies --backoff.')
+
+
+def add_node_argument(parser):
+    parser.add_argument('--node', help='Only handle the repos assigned to this node, one of the configured `nodes`.')
+
+
+def add_policy_arguments(parser):
+    parser.add_argument('--branch', dest='branches', action='append', help='Only back up branches matching this glob (may contain one `*`). May be given multiple times.')
+    parser.add_argument('--exclude-branch', dest='exclude_branches', action='append', help='Do not back up branches matching this glob. May be given multiple times.')
+    parser.add_argument('--depth', type=int, help='Only fetch this many commits of history per branch.')
+    parser.add_argument('--shallow-since', dest='shallow_since', help='Only fetch history after this date.')
+    parser.add_argument('--filter', help='Partial clone filter, e.g. `blob:limit=1m` or `blob:none`. Needs a server allowing filters.')
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -177,26 +1002,141 @@ def main():
 
     parser.add_argument('--config-file', dest='configfile', help='Configuration file')
     parser.add_argument('-y', '--assume-yes', action='store_true', help='Configuration file')
+    parser.add_argument('--no-ssh-multiplex', dest='ssh_multiplex', action='store_false', help='Do not share ssh connections to the same server between git/ssh invocations.')
 
     subparsers = parser.add_subparsers(title='Commands')
 
     parser_updaterepolist = subparsers.add_parser('updaterepolist', help='Check a target server for new, unknown repos. If no target is provided, all configured servers and github users are checked.')
     parser_updaterepolist.add_argument('target', nargs='?', help='May be of the form `[user@]example.com:serverpath` for a server you have ssh access to. Otherwise it is assumed to be a github username.')
     parser_updaterepolist.add_argument('--type', choices=['ssh','github'], default='auto', help='Force how the target value will be interpreted')
+    parser_updaterepolist.add_argument('--max-depth', dest='max_depth', type=int, default=None, help='Only look for repos up to this many directories below the server path.')
+    parser_updaterepolist.add_argument('-j', '--jobs', type=int, default=8, help='Number of indices to check and new repos to initialize at the same time.')
+    parser_updaterepolist.add_argument('--timeout', type=float, default=300, help='Seconds after which checking an index is given up.')
+    parser_updaterepolist.add_argument('--ttl', type=float, help='Reuse the listing of indices checked less than this many seconds ago. Defaults to the `index_ttl` setting.')
+    parser_updaterepolist.add_argument('--pool', help='Add new repos to this shared object pool. `auto` uses one pool per repo name, so forks end up in the same pool.')
+    add_node_argument(parser_updaterepolist)
     parser_updaterepolist.set_defaults(func=run_updaterepolist)
 
     parser_dobackup = subparsers.add_parser('dobackup', help='Do a backup of a repository. If no explicit repo is provided, all configured repos will be backed up.')
     parser_dobackup.add_argument('localpath', nargs='*', help='Local path of the repositories that should be backed up. Needs an initialized git repo at that location. Backs up the origin remote.')
+    parser_dobackup.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to fetch at the same time.')
+    parser_dobackup.add_argument('--host-jobs', dest='host_jobs', type=positive_int, default=None, help='Maximum number of concurrent fetches from the same host, local repos are not limited. Unlimited by default.')
+    parser_dobackup.add_argument('--incremental', action='store_true', help='Check the remote branches with `git ls-remote` first and skip repos that did not change since their last incremental backup.')
+    parser_dobackup.add_argument('--changed-only', dest='changed_only', action='store_true', help='Only create backup refs for branches that changed since the last backup. Same as setting `snapshot_mode` to `changed`.')
+    parser_dobackup.add_argument('--retries', type=int, default=0, help='Number of times a failed fetch is retried.')
+    parser_dobackup.add_argument('--maintain', action='store_true', help='Run maintenance (see `gickup maintain`) on synced repos, while the remaining repos are fetched.')
+    parser_dobackup.add_argument('--maintain-jobs', dest='maintain_jobs', type=int, default=1, help='Number of repos to maintain at the same time.')
+    parser_dobackup.add_argument('--resume', action='store_true', help='Continue the last interrupted or failed run, with the same backup date, skipping the repos it already backed up.')
+    parser_dobackup.add_argument('--restart', action='store_true', help='Start a new run even if the last one was interrupted.')
+    parser_dobackup.add_argument('--report', help='Write a report with time, objects and bytes received per repo to this file.')
+    parser_dobackup.add_argument('--report-format', dest='report_format', choices=['json', 'prometheus'], help='Format of the report. Default is prometheus for *.prom files, json otherwise.')
+    add_throttle_arguments(parser_dobackup)
+    add_node_argument(parser_dobackup)
     parser_dobackup.set_defaults(func=run_dobackup)
 
 
+    parser_daemon = subparsers.add_parser('daemon', help='Keep running and back up all configured repos continuously. Each repo is checked with `git ls-remote` and fetched when it changed. Repos that change often are checked more often.')
+    parser_daemon.add_argument('-j', '--jobs', type=positive_int, default=4, help='Number of repos to check or fetch at the same time.')
+    parser_daemon.add_argument('--host-jobs', dest='host_jobs', type=positive_int, default=None, help='Maximum number of concurrent fetches from the same host, local repos are not limited. Unlimited by default.')
+    parser_daemon.add_argument('--min-interval', dest='min_interval', type=float, default=300, help='Minimum seconds between two checks of the same repo.')
+    parser_daemon.add_argument('--max-interval', dest='max_interval', type=float, default=86400, help='Maximum seconds between two checks of the same repo.')
+    parser_daemon.add_argument('--changed-only', dest='changed_only', action='store_true', help='Only create backup refs for branches that changed since the last backup.')
+    parser_daemon.add_argument('--retries', type=int, default=0, help='Number of times a failed fetch is retried.')
+    parser_daemon.add_argument('--listen', metavar='[ADDRESS:]PORT', help='Listen for push notifications (GitHub webhooks or POSTs of repo urls, e.g. from post-receive hooks) on this port, and back up the repos right after they changed. Listens on localhost unless an address is given, IPv6 addresses go in brackets, e.g. `[::]:8080`.')
+    parser_daemon.add_argument('--debounce', type=float, default=5, help='Seconds without further push notifications to wait for before fetching a pushed repo, so bursts of pushes lead to a single fetch.')
+    parser_daemon.add_argument('--max-debounce', dest='max_debounce', type=float, default=60, help='Seconds after the first push notification after which a repo is fetched even if pushes keep coming.')
+    add_throttle_arguments(parser_daemon)
+    add_node_argument(parser_daemon)
+    parser_daemon.set_defaults(func=run_daemon)
+
+    parser_prune = subparsers.add_parser('prune', help='Delete old backup refs according to a retention policy. Backups are kept hourly for some days, then daily for some days, then monthly. The policy applies to every branch separately and the latest backup of a branch is always kept.')
+    parser_prune.add_argument('localpath', nargs='*', help='Local path of the repositories that should be pruned. If none is given, all configured repos are pruned.')
+    parser_prune.add_argument('--hourly', dest='hourly_days', type=float, help='Days for which hourly backups are kept.')
+    parser_prune.add_argument('--daily', dest='daily_days', type=float, help='Days for which daily backups are kept.')
+    parser_prune.add_argument('--monthly', dest='monthly_days', type=float, help='Days for which monthly backups are kept. Kept forever by default.')
+    parser_prune.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='Only print how many refs would be deleted.')
+    parser_prune.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to prune at the same time.')
+    add_node_argument(parser_prune)
+    parser_prune.set_defaults(func=run_prune)
+
+    parser_maintain = subparsers.add_parser('maintain', help='Keep backup repos fast to fetch into: roll up small packs with a geometric repack, and write the multi-pack-index and commit-graph, as far as each repo needs it.')
+    parser_maintain.add_argument('localpath', nargs='*', help='Local path of the repositories to maintain. If none is given, all configured repos and object pools are maintained.')
+    parser_maintain.add_argument('--max-packs', dest='max_packs', type=int, help='Repack repos with more packs than this.')
+    parser_maintain.add_argument('--max-loose-objects', dest='max_loose_objects', type=int, help='Repack repos with more loose objects than this.')
+    parser_maintain.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='Only print what would be done.')
+    parser_maintain.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to maintain at the same time.')
+    add_node_argument(parser_maintain)
+    parser_maintain.set_defaults(func=run_maintain)
+
+    parser_verify = subparsers.add_parser('verify', help='Check that backups are intact: the checksums of all objects and that the history of every ref is complete. After a first full check, only packs, loose objects and history added since the last check of a repo are verified.')
+    parser_verify.add_argument('localpath', nargs='*', help='Local path of the repositories to verify. If none is given, all configured repos and object pools are verified.')
+    parser_verify.add_argument('--full', action='store_true', help='Check everything again with `git fsck`.')
+    parser_verify.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to verify at the same time.')
+    parser_verify.add_argument('--report', help='Write the results as JSON to this file.')
+    add_node_argument(parser_verify)
+    parser_verify.set_defaults(func=run_verify)
+
+    parser_export = subparsers.add_parser('export', help='Write incremental git bundles of backup repos for offsite copies, each containing only what was added since the last export. Exports of a repo are kept in a directory named like the repo relative to <localbasepath>.')
+    parser_export.add_argument('target', help='Directory to write the exports to, or a tar file with `--tar` (`-` for stdout).')
+    parser_export.add_argument('localpath', nargs='*', help='Local path of the repositories to export. If none is given, all configured repos are exported.')
+    parser_export.add_argument('--tar', action='store_true', help='Write the new exports into a tar file instead.')
+    parser_export.add_argument('-j', '--jobs', type=int, default=1, help='Number of bundles to build at the same time.')
+    add_node_argument(parser_export)
+    parser_export.set_defaults(func=run_export)
+
+    parser_restorebundles = subparsers.add_parser('restorebundles', help='Recreate a backup repo from the exports written by `export`, and add it to the backup list.')
+    parser_restorebundles.add_argument('source', help='Directory with the exports of the repo.')
+    parser_restorebundles.add_argument('localpath', help='Local path to restore the repo to.')
+    parser_restorebundles.add_argument('--seq', type=int, help='Restore this export instead of the newest one.')
+    parser_restorebundles.add_argument('--url', help='Url of the repo, if it should differ from the exported one.')
+    parser_restorebundles.set_defaults(func=run_restorebundles)
+
+    parser_rebalance = subparsers.add_parser('rebalance', help='Assign the configured repos to the configured nodes, so every node gets its share of the total fetch time (see `--node`). Moves as few repos as possible.')
+    parser_rebalance.add_argument('--slack', type=float, default=0.25, help='Fraction by which the fetch time of a node may exceed its share.')
+    parser_rebalance.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='Only print how many repos would move.')
+    parser_rebalance.set_defaults(func=run_rebalance)
+
+    parser_log = subparsers.add_parser('log', help='Show the branch changes recorded by the backups of a repo, or the branches at some point in time.')
+    parser_log.add_argument('localpath', help='Local path of the repository.')
+    parser_log.add_argument('branch', nargs='?', help='Only show this branch.')
+    parser_log.add_argument('--at', help='Show the commit ids of all branches (or the given one) as of this date, e.g. `2017-05-01 12:00`.')
+    parser_log.add_argument('--since', help='Only show changes after this date.')
+    parser_log.add_argument('--until', help='Only show changes before this date.')
+    parser_log.set_defaults(func=run_log)
+
+    parser_restore = subparsers.add_parser('restore', help='Restore the branches of a repo as they were backed up at some point in time.')
+    parser_restore.add_argument('localpath', help='Local path of the repository.')
+    parser_restore.add_argument('dest', help='Directory to restore to. Becomes a git repo with all branches, unless `--branch` is given.')
+    parser_restore.add_argument('--at', required=True, help='Date to restore, e.g. `2017-05-01 12:00`.')
+    parser_restore.add_argument('--branch', help='Only write the files of this branch to the directory.')
+    parser_restore.set_defaults(func=run_restore)
+
+    parser_reindex = subparsers.add_parser('reindex', help='Rebuild the snapshot index of repos, used by `log` and `restore`, from their backup refs.')
+    parser_reindex.add_argument('localpath', nargs='*', help='Local path of the repositories. If none is given, all configured repos are indexed.')
+    parser_reindex.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to index at the same time.')
+    add_node_argument(parser_reindex)
+    parser_reindex.set_defaults(func=run_reindex)
+
     parser_addrepo = subparsers.add_parser('addrepo', help='Add a new repository to the backup list')
     parser_addrepo.add_argument('repourl', help='Url of the repository to be backed up')
     parser_addrepo.add_argument('backuppath', nargs='?', help='Local path to where the repo should be backed up to. Default is <homedir>/backup/<servername>/<reponame>. Relative paths are interpreted relative to <localbasepath>, <homedir>/backup by default.')
+    parser_addrepo.add_argument('--pool', help='Share objects with other repos in this pool, stored in <localbasepath>/.pools. `auto` uses the repo name.')
+    add_policy_arguments(parser_addrepo)
     parser_addrepo.set_defaults(func=run_addrepo)
 
+    parser_joinpool = subparsers.add_parser('joinpool', help='Move the objects of configured repos into a shared object pool. Later fetches only download objects missing in the pool.')
+    parser_joinpool.add_argument('name', help='Name of the pool, `auto` to use the repo name.')
+    parser_joinpool.add_argument('localpath', nargs='+', help='Local path of the repositories to add to the pool.')
+    parser_joinpool.set_defaults(func=run_joinpool)
+
+    parser_setpolicy = subparsers.add_parser('setpolicy', help='Set the fetch policy of configured repos, limiting the branches and history that are backed up. Without options, print the current policies.')
+    parser_setpolicy.add_argument('localpath', nargs='*', help='Local path of the repositories. If none is given, the policy of all configured repos is set.')
+    parser_setpolicy.add_argument('--clear', action='store_true', help='Remove the policy, backing up everything again.')
+    add_policy_arguments(parser_setpolicy)
+    parser_setpolicy.set_defaults(func=run_setpolicy)
+
     parser_setconfig = subparsers.add_parser('setconfig', help='Set a config value')
-    parser_setconfig.add_argument('name', choices=['dateformat', 'localbasepath'])
+    parser_setconfig.add_argument('name', choices=['dateformat', 'localbasepath', 'registry', 'snapshot_mode', 'github_api_url', 'github_token', 'webhook_secret'])
     parser_setconfig.add_argument('newvalue')
     parser_setconfig.set_defaults(func=run_setconfig)
 
@@ -246,7 +1186,7 @@ def main():
 
             args.configfile = os.path.expanduser(args.configfile)
 
-            if not os.path.exists(cf):
+            if not os.path.exists(args.configfile):
                 pass #TODO explicitly given, non existant
 
         # load settings / defaults
@@ -254,7 +1194,7 @@ def main():
             settings = helpers.loadsettings(args.configfile)
         except FileNotFoundError:
             print('Found no settings file, using defaults.')
-            settings = helpers.DEFAULT_SETTINGS
+            settings = copy.deepcopy(helpers.DEFAULT_SETTINGS)
 
         # set default localbasepath
         if settings['localbasepath'] is None:
@@ -263,6 +1203,12 @@ def main():
                     default_first=True
                 )
 
+        settings['repos'] = helpers.openregistry(args.configfile, settings)
+
+        if getattr(args, 'node', None) is not None and not args.node in settings['nodes']:
+            print('Unknown node {}, configured are: {}'.format(args.node, ', '.join(sorted(settings['nodes'])) or 'none'))
+            exit(1)
+
         # run main func
         args.func(args, settings)
 
@@ -0,0 +1,186 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import time
+
+from . import gblib
+from . import helpers
+from . import policies
+from . import pools
+from . import snapshots
+from . import telemetry
+
+
+def get_repo_host(repo):
+    """
+    Return the host a repo is fetched from, looking up its url if necessary.
+    """
+    if repo.url is None:
+        try:
+            repo.url = repo.get_remote_url()
+        except subprocess.CalledProcessError:
+            return None
+    return gblib.url_host(repo.url)
+
+
+class RepoBackup(object):
+    """
+    Backs up single repos, as done by `dobackup` and the daemon.
+
+    If `refstate` is given (a dict of repo paths to remote branch heads),
+    unchanged repos are skipped after a `git ls-remote`. With
+    `init_missing`, backup repos that do not exist yet are initialized.
+    """
+
+    def __init__(self, settings, ssh_pool=None, refstate=None, changed_only=False, retries=0, quiet=False,
+            rate_limiter=None, command_prefix=None, host_backoff=None, init_missing=False):
+        self.settings = settings
+        self.ssh_pool = ssh_pool
+        self.refstate = refstate
+        self.changed_only = changed_only
+        self.retries = retries
+        self.quiet = quiet
+        self.rate_limiter = rate_limiter
+        self.command_prefix = command_prefix or []
+        self.host_backoff = host_backoff
+        self.init_missing = init_missing
+        self._ssh_command = None
+
+    def backup(self, repo, date):
+        """
+        Back up `repo` into a snapshot for `date`, retrying failed fetches.
+
+        Returns a `telemetry.FetchRecord` with status `synced`, `unchanged` or
+        `failed`.
+        """
+        record = telemetry.FetchRecord(repo.git_dir, repo.url)
+        repo.command_prefix = self.command_prefix
+        host = get_repo_host(repo)
+        start = time.monotonic()
+
+        try:
+            for attempt in range(self.retries + 1):
+                if self.host_backoff is not None:
+                    self.host_backoff.wait(host)
+                attempt_start = time.monotonic()
+                try:
+                    synced = self._backup_once(repo, date, record)
+                    record.exit_code = 0
+                    record.status = 'synced' if synced else 'unchanged'
+                    if self.host_backoff is not None:
+                        self.host_backoff.report(host, True, time.monotonic() - attempt_start)
+                    break
+                except subprocess.CalledProcessError as e:
+                    record.exit_code = e.returncode
+                    if self.host_backoff is not None:
+                        self.host_backoff.report(host, False)
+                    if attempt == self.retries:
+                        record.status = 'failed'
+                        record.error = helpers.format_error(e)
+                        break
+                    record.retries += 1
+                    print('Retrying {}'.format(repo.git_dir))
+                    if self.host_backoff is None:
+                        time.sleep(min(2 ** attempt, 60))
+        finally:
+            record.duration = time.monotonic() - start
+
+        return record
+
+    def update_registry(self, record):
+        """
+        Save the outcome of a backup in the repo's registry metadata.
+        """
+        registry = self.settings['repos']
+        if not record.url in registry:
+            return
+
+        now = time.time()
+        if record.status == 'failed':
+            registry.update_meta(record.url, last_status='failed', last_error=record.error)
+        elif record.status == 'synced':
+            registry.update_meta(record.url, last_status='ok', last_error=None, last_check=now, last_fetch=now, last_duration=record.duration)
+        else:
+            registry.update_meta(record.url, last_status='ok', last_error=None, last_check=now)
+
+    def get_meta(self, repo):
+        registry = self.settings['repos']
+        if repo.url is None or not repo.url in registry:
+            return {}
+        return registry.get_meta(repo.url)
+
+    def connect(self, repo):
+        if repo.url is None or gblib.url_split_type_target(repo.url)[0] != 'ssh':
+            return
+        # otherwise git's own ssh configuration applies
+        if self.ssh_pool is None and self.rate_limiter is None:
+            return
+
+        # share one ssh connection per server between all fetches
+        if self.ssh_pool is not None:
+            repo.ssh_command = self.ssh_pool.get_ssh_command(gblib.url_server_address(repo.url))
+        else:
+            repo.ssh_command = self.get_ssh_command()
+
+        if self.rate_limiter is not None:
+            repo.ssh_command = self.rate_limiter.get_command(get_repo_host(repo), repo.ssh_command)
+
+    def get_ssh_command(self):
+        if self._ssh_command is None:
+            self._ssh_command = gblib.get_ssh_command()
+        return self._ssh_command
+
+    def _backup_once(self, repo, date, record):
+        if self.init_missing and repo.url is not None and not os.path.exists(repo.git_dir):
+            print('Initializing {}'.format(repo.git_dir))
+            gblib.create_bare_repo(repo.url, repo.git_dir)
+
+        meta = self.get_meta(repo)
+        policy = meta.get('fetch_policy')
+
+        # the repo was renamed upstream while this backup did not exist here
+        if meta.get('update_origin'):
+            repo.set_config('remote.origin.url', repo.url)
+            self.settings['repos'].update_meta(repo.url, update_origin=None)
+
+        if self.refstate is not None:
+            self.connect(repo)
+            heads = policies.filter_heads(policy, repo.ls_remote())
+            if self.refstate.get(repo.git_dir) == heads:
+                print('Unchanged {}'.format(repo.git_dir))
+                return False
+
+        print('Syncing {}'.format(repo.git_dir))
+        self.connect(repo)
+        if self.changed_only:
+            _, stats = snapshots.backup_changed(repo, date, self.settings['dateformat'], quiet=self.quiet, policy=policy)
+        else:
+            refspecs = snapshots.get_backup_refspecs(date, self.settings['dateformat'], policy)
+            stats = repo.fetch(refspec=refspecs, quiet=self.quiet, **policies.get_fetch_options(policy))
+            snapshots.record_snapshot(repo, date, self.settings['dateformat'])
+        record.objects = stats['objects']
+        record.bytes = stats['bytes']
+
+        # the pool would have to fetch the objects left out by a filter
+        if meta.get('pool') is not None and not (policy or {}).get('filter'):
+            pools.update_pool(repo, pools.get_pool_path(self.settings, meta['pool']))
+
+        if self.refstate is not None:
+            self.refstate[repo.git_dir] = heads
+        return True
@@ -0,0 +1,231 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import threading
+import time
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from . import backup
+from . import gblib
+from . import helpers
+from . import webhooks
+
+
+def adapt_interval(interval, changed, min_interval, max_interval):
+    """
+    Halve the fetch interval of a repo that changed, double it otherwise.
+    """
+    if changed:
+        interval /= 2
+    else:
+        interval *= 2
+    return max(min_interval, min(max_interval, interval))
+
+
+class Daemon(object):
+    """
+    Backs up all registered repos continuously, each one as often as it
+    changes: the interval of a repo (within `min_interval` and
+    `max_interval` seconds) is halved whenever a backup finds changes and
+    doubled otherwise. `notify` queues repos that were pushed to (see
+    `webhooks`), debounced by `debounce` up to `max_debounce` seconds.
+
+    If `select` is given, it is called with the url, path and metadata of
+    every registered repo and returns the path to back it up to, or None to
+    leave the repo out.
+    """
+
+    def __init__(self, repo_backup, registry, jobs=1, host_jobs=None,
+            min_interval=300, max_interval=86400, rescan_interval=60, on_rescan=None, debounce=5, max_debounce=60, select=None):
+        self.repo_backup = repo_backup
+        self.registry = registry
+        self.jobs = jobs
+        self.host_jobs = host_jobs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rescan_interval = rescan_interval
+        self.on_rescan = on_rescan
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.select = select
+
+        self._queue = []
+        self._due = {}
+        self._repos = {}
+        self._keys = {}
+        self._intervals = {}
+        self._stop = threading.Event()
+
+        # notifications from other threads, handled by the main loop; `stop`
+        # may be called from a signal handler while the lock is held
+        self._lock = threading.RLock()
+        self._notified = set()
+        self._wakeup = Future()
+        self._refetch = set()
+        # time of the first push not backed up yet, per repo
+        self._pushed = {}
+
+    def stop(self):
+        self._stop.set()
+        self._wake()
+
+    def notify(self, urls):
+        """
+        Queue the backup of the registered repos matching `urls` (see
+        `webhooks.get_url_key`). Returns the local paths of these repos.
+        """
+        matched = set()
+        for url in urls:
+            matched.update(self._keys.get(webhooks.get_url_key(url), []))
+
+        repos = self._repos
+        matched = sorted(u for u in matched if u in repos)
+        if matched:
+            with self._lock:
+                self._notified.update(matched)
+            self._wake()
+        return [repos[u] for u in matched]
+
+    def _wake(self):
+        with self._lock:
+            if not self._wakeup.done():
+                self._wakeup.set_result(None)
+
+    def _handle_notifications(self, running_urls):
+        with self._lock:
+            notified = self._notified
+            self._notified = set()
+            self._wakeup = Future()
+
+        now = time.time()
+        for url in notified:
+            if not url in self._repos:
+                continue
+            print('Change notification for {}'.format(self._repos[url]))
+            due = self._get_push_due(url, now)
+            if url in running_urls:
+                self._refetch.add(url)
+            else:
+                # every push postpones the backup again
+                self._schedule(url, due)
+
+    def _get_push_due(self, url, now):
+        first = self._pushed.setdefault(url, now)
+        return min(now + self.debounce, first + self.max_debounce)
+
+    def run(self):
+        running = {}
+        active_hosts = collections.Counter()
+        last_rescan = None
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while not self._stop.is_set() or running:
+
+                self._handle_notifications(set(url for url, host in running.values()))
+
+                now = time.time()
+                if not self._stop.is_set() and (last_rescan is None or now - last_rescan >= self.rescan_interval):
+                    self._rescan()
+                    last_rescan = now
+                    if self.on_rescan is not None:
+                        self.on_rescan()
+
+                # start due repos, as far as the concurrency limits allow
+                deferred = []
+                while not self._stop.is_set() and self._queue and self._queue[0][0] <= now and len(running) < self.jobs:
+                    due, url = heapq.heappop(self._queue)
+                    if not url in self._repos or self._due.get(url) != due:
+                        # removed from the registry or rescheduled
+                        continue
+                    repo = gblib.Repo(self._repos[url], url)
+                    host = backup.get_repo_host(repo)
+                    if self.host_jobs is not None and host is not None and active_hosts[host] >= self.host_jobs:
+                        deferred.append((due, url))
+                        continue
+                    active_hosts[host] += 1
+                    del self._due[url]
+                    self._pushed.pop(url, None)
+                    running[executor.submit(self.repo_backup.backup, repo, datetime.now())] = (url, host)
+                for due, url in deferred:
+                    self._schedule(url, due)
+
+                # sleep until a backup finishes, the next one is due or the
+                # registry is to be checked again
+                timeout = self.rescan_interval
+                if self._queue and not deferred:
+                    timeout = min(timeout, max(0, self._queue[0][0] - time.time()))
+                done, _ = wait(list(running) + [self._wakeup], timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if not future in running:
+                        continue
+                    url, host = running.pop(future)
+                    active_hosts[host] -= 1
+                    self._finish(url, future)
+
+    def _finish(self, url, future):
+        try:
+            record = future.result()
+        except Exception as e:
+            print('Failed to sync {}: {}'.format(self._repos.get(url, url), helpers.format_error(e)))
+            changed = False
+        else:
+            self.repo_backup.update_registry(record)
+            if record.status == 'failed':
+                print('Failed to sync {}: {}'.format(record.path, record.error))
+            changed = record.status == 'synced'
+
+        if not url in self._repos:
+            return
+
+        interval = adapt_interval(self._intervals[url], changed, self.min_interval, self.max_interval)
+        due = time.time() + interval
+        self._intervals[url] = interval
+        if url in self._refetch:
+            self._refetch.discard(url)
+            due = self._get_push_due(url, time.time())
+        self._schedule(url, due)
+
+        if url in self.registry:
+            self.registry.update_meta(url, fetch_interval=interval, next_fetch=due)
+
+    def _schedule(self, url, due):
+        self._due[url] = due
+        heapq.heappush(self._queue, (due, url))
+
+    def _rescan(self):
+        now = time.time()
+        repos = {}
+        keys = collections.defaultdict(list)
+
+        for url, path, meta in self.registry.items_with_meta():
+            if self.select is not None:
+                path = self.select(url, path, meta)
+                if path is None:
+                    continue
+            repos[url] = path
+            keys[webhooks.get_url_key(url)].append(url)
+            if not url in self._repos:
+                self._intervals[url] = meta.get('fetch_interval', self.min_interval)
+                self._schedule(url, meta.get('next_fetch', now))
+
+        # repos missing now are dropped from the queue when they come up
+        self._repos = repos
+        self._keys = dict(keys)
@@ -0,0 +1,200 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Incremental exports of backup repos as git bundles, for offsite copies.
+#
+# Every export is numbered: `<seq>.bundle` holds the objects added since its
+# `base` export (left out if there are none), `<seq>.json` the url and all
+# refs, which git leaves out of bundles whose commits it already exported.
+# The refs of the last finished export are kept below `refs/gickup/exported/`
+# as the base of the next one.
+
+import os
+import glob
+import json
+import hashlib
+
+from . import gblib
+from . import helpers
+
+
+EXPORTED_REF_PREFIX = 'refs/gickup/exported/'
+
+
+def get_export_path(localbasepath, git_dir):
+    """
+    Return the directory of a repo's exports, relative to the export target:
+    its path relative to `localbasepath` if it is in there.
+    """
+    relpath = os.path.relpath(git_dir, localbasepath)
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.path.sep):
+        relpath = git_dir.lstrip(os.path.sep)
+    return relpath
+
+
+def get_export_state_path(git_dir):
+    return os.path.join(git_dir, 'gickup', 'export')
+
+
+def load_export_state(git_dir):
+    """
+    Return the export state of a repo: the last export number used (`seq`),
+    the last finished export (`base`) and a hash of its refs.
+    """
+    return helpers.loadstate(get_export_state_path(git_dir), {'seq': 0, 'base': None, 'refs_hash': None})
+
+
+def get_refs_hash(refs):
+    return hashlib.sha1(json.dumps(sorted(refs.items())).encode()).hexdigest()
+
+
+class Export(object):
+    """
+    An export written by `create_export`, to be finished with
+    `finish_export`. `files` are the names of the files written.
+    """
+
+    def __init__(self, repo, seq, directory, refs):
+        self.repo = repo
+        self.seq = seq
+        self.directory = directory
+        self.refs = refs
+        self.files = []
+
+    @property
+    def name(self):
+        return '{:06d}'.format(self.seq)
+
+
+def create_export(repo, directory, date, url=None):
+    """
+    Write the next export of `repo` into `directory`, containing the objects
+    added since the last finished export.
+
+    Returns an `Export`, or None if the refs did not change since then.
+    The next export is based on this one only after `finish_export`.
+    """
+    state = load_export_state(repo.git_dir)
+    refs = dict(r for r in repo.for_each_ref('refs/') if not r[0].startswith(EXPORTED_REF_PREFIX))
+    if get_refs_hash(refs) == state['refs_hash']:
+        return None
+
+    # the number is used up even if the export is never finished, so
+    # unfinished exports are never overwritten
+    state['seq'] += 1
+    helpers.savestate(get_export_state_path(repo.git_dir), state)
+    export = Export(repo, state['seq'], directory, refs)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    exported = set(sha for ref, sha in repo.for_each_ref(EXPORTED_REF_PREFIX))
+    new_refs = sorted(ref for ref, sha in refs.items() if not sha in exported)
+
+    bundle = None
+    if new_refs and repo.create_bundle(os.path.join(directory, export.name + '.bundle'), new_refs, sorted(exported)):
+        bundle = export.name + '.bundle'
+        export.files.append(bundle)
+
+    helpers.savestate(os.path.join(directory, export.name + '.json'), {
+            'seq': export.seq,
+            'base': state['base'],
+            'date': date.isoformat(),
+            'url': url,
+            'bundle': bundle,
+            'refs': refs,
+        })
+    export.files.append(export.name + '.json')
+
+    return export
+
+
+def finish_export(export):
+    """
+    Base the next export of the repo on `export`, once its files are stored
+    safely.
+    """
+    repo = export.repo
+    state = load_export_state(repo.git_dir)
+    state['base'] = export.seq
+    state['refs_hash'] = get_refs_hash(export.refs)
+    # the state goes first: with old watermark refs, the next bundle only
+    # contains more objects than necessary
+    helpers.savestate(get_export_state_path(repo.git_dir), state)
+
+    old = set(sha for ref, sha in repo.for_each_ref(EXPORTED_REF_PREFIX))
+    new = set(export.refs.values())
+    commands = ['delete {}{} {}'.format(EXPORTED_REF_PREFIX, sha, sha) for sha in sorted(old - new)]
+    commands += ['create {}{} {}'.format(EXPORTED_REF_PREFIX, sha, sha) for sha in sorted(new - old)]
+    if commands:
+        repo.update_refs(commands)
+
+
+def load_manifests(directory):
+    manifests = {}
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        manifests[manifest['seq']] = manifest
+    return manifests
+
+
+def get_export_chain(manifests, seq=None):
+    """
+    Return the manifests needed to restore export `seq` (the newest by
+    default), oldest first.
+    """
+    if not manifests:
+        raise ValueError('No exports found')
+    if seq is None:
+        seq = max(manifests)
+
+    chain = []
+    while seq is not None:
+        if not seq in manifests:
+            raise ValueError('Export {:06d} is missing{}'.format(seq,
+                ', needed by {:06d}'.format(chain[-1]['seq']) if chain else ''))
+        chain.append(manifests[seq])
+        seq = manifests[seq]['base']
+
+    chain.reverse()
+    return chain
+
+
+def restore_repo(directory, localpath, seq=None, url=None):
+    """
+    Create a backup repo at `localpath` from the exports of a repo in
+    `directory`, as of export `seq` (the newest by default). The origin
+    url is taken from the manifest, unless `url` is given.
+
+    Returns the manifest of the restored export.
+    """
+    chain = get_export_chain(load_manifests(directory), seq)
+    manifest = chain[-1]
+
+    url = url or manifest['url']
+    if url is None:
+        raise ValueError('The exports do not record the url of the repo')
+
+    gblib.init_repo(url, localpath)
+    repo = gblib.Repo(localpath)
+    for m in chain:
+        if m['bundle'] is not None:
+            repo.unbundle(os.path.join(directory, m['bundle']))
+
+    repo.update_refs(['create {} {}'.format(ref, sha) for ref, sha in sorted(manifest['refs'].items())])
+    return manifest
@@ -16,19 +16,250 @@
 # along with Gickup. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
+import codecs
 import subprocess
 import re
+import shlex
 
 
 class Repo(object):
     git_dir = None
+    url = None
 
-    def __init__(self, path):
+    # ssh command line (as a list) used by git to reach the remote
+    ssh_command = None
+
+    # prepended to all git command lines, e.g. to lower their priority
+    command_prefix = []
+
+    def __init__(self, path, url=None):
         self.git_dir = path
+        self.url = url
+
+    def fetch(self, refspec='', remote='origin', quiet=False, prune=False, depth=None, shallow_since=None, filter_spec=None):
+        """
+        Fetch from `remote`. `refspec` may be a list of refspecs.
+
+        `depth` and `shallow_since` limit the history fetched, `filter_spec`
+        is a partial clone filter (which makes `remote` a promisor remote).
+
+        Git's progress output is passed through as it arrives, unless
+        `quiet` is set.
+
+        Returns a dict with the number of `objects` and `bytes` received, as
+        far as git reports them. Git only reports the size of received packs,
+        not of fetches small enough to be unpacked, `bytes` is None then.
+        """
+        l = self._get_git_args()
+        # progress is still reported with --quiet, as it is parsed
+        l += ['fetch', '--progress']
+        if quiet:
+            l += ['--quiet']
+        if prune:
+            l += ['--prune']
+        if depth is not None:
+            l += ['--depth', str(depth)]
+        if shallow_since is not None:
+            l += ['--shallow-since', shallow_since]
+        if filter_spec is not None:
+            l += ['--filter', filter_spec]
+        l += [remote]
+        l += refspec if isinstance(refspec, list) else [refspec]
+
+        # progress output is parsed, so have git report it right away and
+        # untranslated
+        env = dict(os.environ, GIT_PROGRESS_DELAY='0', LC_ALL='C', LANGUAGE='C')
+        p = subprocess.Popen(l, stderr=subprocess.PIPE, env=env)
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # progress lines are updated in place (ending in `\r`), which only
+        # makes sense on a terminal, elsewhere only their final state is shown
+        live = sys.stderr.isatty()
+        output = []
+        line = ''
+        with p.stderr:
+            for chunk in iter(lambda: p.stderr.read1(4096), b''):
+                text = decoder.decode(chunk)
+                output.append(text)
+                if quiet:
+                    continue
+                if live:
+                    sys.stderr.write(text)
+                    sys.stderr.flush()
+                    continue
+                line += text
+                while '\n' in line:
+                    done, line = line.split('\n', 1)
+                    sys.stderr.write(done.rsplit('\r', 1)[-1] + '\n')
+        if line and not quiet and not live:
+            sys.stderr.write(line.rsplit('\r', 1)[-1] + '\n')
+        output = ''.join(output) + decoder.decode(b'', final=True)
+
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, l, stderr=output)
+
+        return parse_fetch_progress(output)
+
+    def ls_remote(self, remote='origin'):
+        """
+        Return a dict of the remote's branch names and their commit ids.
+        """
+        l = self._get_git_args()
+        l += ['ls-remote', '--heads', remote]
+        heads = {}
+        for line in subprocess.check_output(l).decode().splitlines():
+            sha, ref = line.split('\t', 1)
+            heads[ref] = sha
+        return heads
+
+    def for_each_ref(self, pattern):
+        """
+        Return a list of `(refname, sha)` tuples of all refs matching
+        `pattern`.
+        """
+        l = self._get_git_args()
+        l += ['for-each-ref', '--format=%(refname) %(objectname)', pattern]
+        return [tuple(line.split(' ', 1)) for line in subprocess.check_output(l).decode().splitlines()]
+
+    def update_refs(self, commands):
+        """
+        Apply a list of `git update-ref --stdin` commands in one transaction.
+        """
+        l = self._get_git_args()
+        l += ['update-ref', '--stdin']
+        subprocess.run(l, input=''.join(c + '\n' for c in commands).encode(), check=True)
+
+    def pack_refs(self):
+        l = self._get_git_args()
+        l += ['pack-refs', '--all', '--prune']
+        subprocess.check_call(l)
+
+    def get_remote_url(self, remote='origin'):
+        l = self._get_git_args()
+        l += ['config', '--get', 'remote.{}.url'.format(remote)]
+        return subprocess.check_output(l).decode().strip()
+
+    def set_config(self, key, value):
+        l = self._get_git_args()
+        l += ['config', key, value]
+        subprocess.check_call(l)
+
+    def repack(self, options):
+        l = self._get_git_args()
+        l += ['repack', '-q'] + options
+        subprocess.check_call(l)
+
+    def count_objects(self):
+        """
+        Return the statistics of `git count-objects -v` as a dict (sizes in
+        KiB).
+        """
+        l = self._get_git_args()
+        l += ['count-objects', '-v']
+        stats = {}
+        for line in subprocess.check_output(l).decode().splitlines():
+            k, v = line.split(':', 1)
+            # there are `alternate` lines as well
+            if v.strip().isdigit():
+                stats[k] = int(v)
+        return stats
+
+    def write_commit_graph(self):
+        l = self._get_git_args()
+        l += ['commit-graph', 'write', '--reachable', '--split', '--no-progress']
+        subprocess.check_call(l)
+
+    def write_multi_pack_index(self):
+        l = self._get_git_args()
+        l += ['multi-pack-index', 'write', '--no-progress']
+        subprocess.check_call(l)
+
+    def verify_pack(self, idx_path):
+        """
+        Check the checksums of a pack and all objects in it.
+        """
+        l = self._get_git_args()
+        l += ['verify-pack', idx_path]
+        p = subprocess.run(l, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, l, stderr=p.stderr.decode(errors='replace'))
+
+    def find_missing_objects(self, tips, known_tips=(), allow_promisor=False):
+        """
+        Walk the history from `tips`, excluding everything reachable from
+        `known_tips`, and return the ids of missing objects. Fails if
+        objects cannot be read.
+
+        With `allow_promisor`, objects a promisor remote can provide (those
+        left out by a partial clone filter) do not count as missing.
+        """
+        l = self._get_git_args()
+        l += ['rev-list', '--objects', '--stdin']
+        l += ['--missing=allow-promisor' if allow_promisor else '--missing=print']
+        revs = ''.join(t + '\n' for t in tips) + ''.join('^' + t + '\n' for t in known_tips)
+        p = subprocess.run(l, input=revs.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, l, stderr=p.stderr.decode(errors='replace'))
+        return [line[1:] for line in p.stdout.decode().splitlines() if line.startswith('?')]
+
+    def fsck(self):
+        """
+        Check all objects and their connectivity. Returns the problems found.
+        """
+        l = self._get_git_args()
+        l += ['fsck', '--no-dangling', '--no-progress']
+        p = subprocess.run(l, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode == 0:
+            return []
+        problems = [line for line in p.stdout.decode(errors='replace').splitlines() if not line.startswith('notice:')]
+        return problems or ['git fsck failed with exit code {}'.format(p.returncode)]
+
+    def create_bundle(self, path, refs, exclude=()):
+        """
+        Write a bundle of `refs` with the objects reachable from them, except
+        those reachable from the commits in `exclude`, which the bundle then
+        requires. Refs pointing into `exclude` are left out.
+
+        Returns False, writing no bundle, if there are no objects to include.
+        """
+        l = self._get_git_args()
+        l += ['bundle', 'create', '-q', path, '--stdin']
+        revs = ''.join(r + '\n' for r in refs) + ''.join('^' + e + '\n' for e in exclude)
+        # the message is matched below
+        env = dict(os.environ, LC_ALL='C')
+        p = subprocess.run(l, input=revs.encode(), stderr=subprocess.PIPE, env=env)
+        stderr = p.stderr.decode(errors='replace')
+        if p.returncode != 0:
+            if 'empty bundle' in stderr:
+                return False
+            raise subprocess.CalledProcessError(p.returncode, l, stderr=stderr)
+        return True
+
+    def unbundle(self, path):
+        """
+        Add the objects of a bundle to the repo, without creating any refs.
+        """
+        l = self._get_git_args()
+        l += ['bundle', 'unbundle', path]
+        subprocess.run(l, stdout=subprocess.DEVNULL, check=True)
+
+    def archive(self, treeish, dest):
+        """
+        Write the files of `treeish` into the directory `dest`.
+        """
+        l = self._get_git_args()
+        l += ['archive', '--format=tar', treeish]
+        git = subprocess.Popen(l, stdout=subprocess.PIPE)
+        with git.stdout:
+            tar = subprocess.run(['tar', '-x', '-C', dest], stdin=git.stdout)
+        if git.wait() != 0:
+            raise subprocess.CalledProcessError(git.returncode, l)
+        tar.check_returncode()
 
-    def fetch(self, refspec='', remote='origin'):
+    def push(self, remote, refspecs):
         l = self._get_git_args()
-        l += ['fetch', remote, refspec]
+        l += ['push', '-q', remote] + refspecs
         subprocess.check_call(l)
 
     def init(self, bare=True):
@@ -47,7 +278,53 @@ class Repo(object):
         subprocess.check_call(l)
 
     def _get_git_args(self):
-        return ['git', '--git-dir', self.git_dir]
+        l = list(self.command_prefix)
+        if self.ssh_command is not None:
+            # GIT_SSH_COMMAND takes precedence over any ssh configuration
+            l += ['env', 'GIT_SSH_COMMAND={}'.format(' '.join(shlex.quote(a) for a in self.ssh_command))]
+        l += ['git', '--git-dir', self.git_dir]
+        return l
+
+
+def parse_fetch_progress(output):
+    """
+    Extract the number of objects and bytes received from the progress
+    output of `git fetch`.
+    """
+    objects = None
+    size = None
+
+    for match in re.finditer(r'remote: Total (\d+)', output):
+        objects = int(match.group(1))
+
+    for match in re.finditer(r'(?:Receiving|Unpacking) objects: +\d+% \((\d+)/\d+\)(?:, ([\d.]+) (bytes|KiB|MiB|GiB))?', output):
+        objects = int(match.group(1))
+        if match.group(2) is not None:
+            factor = {'bytes': 1, 'KiB': 1<<10, 'MiB': 1<<20, 'GiB': 1<<30}[match.group(3)]
+            size = int(float(match.group(2)) * factor)
+
+    if objects is None:
+        # no pack was transferred
+        objects = size = 0
+
+    return {'objects': objects, 'bytes': size}
+
+
+def get_ssh_command():
+    """
+    Return the ssh command line (as a list) git uses by default: the one
+    configured in `GIT_SSH_COMMAND`, `core.sshCommand` or `GIT_SSH`, or
+    plain `ssh`.
+    """
+    command = os.environ.get('GIT_SSH_COMMAND')
+    if not command:
+        p = subprocess.run(['git', 'config', '--get', 'core.sshCommand'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        command = p.stdout.decode().strip()
+    if command:
+        return shlex.split(command)
+    if os.environ.get('GIT_SSH'):
+        return [os.environ['GIT_SSH']]
+    return ['ssh']
 
 
 def url_split_type_target(url):
@@ -71,6 +348,37 @@ def url_split_type_target(url):
     return uri_type, target
 
 
+def url_server_address(url):
+    """
+    Return the `[user@]host[:port]` part of a repo url, or None for local
+    repos.
+    """
+    uri_type, target = url_split_type_target(url)
+
+    if uri_type == 'file':
+        return None
+
+    elif uri_type == 'ssh' and not '://' in url:
+        # user@domain:path
+        return target.split(':', 1)[0]
+
+    else:
+        # user@domain:port/path
+        return target.split('/', 1)[0]
+
+
+def url_host(url):
+    """
+    Return the bare host name of a repo url, or None for local repos.
+    """
+    address = url_server_address(url)
+
+    if address is None:
+        return None
+
+    return address.rsplit('@', 1)[-1].split(':', 1)[0]
+
+
 def generate_backup_path_from_url(repourl):
     uri_type, target = url_split_type_target(repourl)
 
@@ -96,3 +404,48 @@ def init_repo(url, localpath):
     repo = Repo(localpath)
     repo.init(bare=True)
     repo.new_remote(name='origin', url=url)
+
+
+def create_bare_repo(url, localpath):
+    """
+    Same as `init_repo`, but writes the repo files directly instead of
+    running git. The repo is assembled in a temporary directory and moved
+    into place at the end, so an interrupted call leaves no half-initialized
+    repo behind. Returns False if `localpath` already holds a repo with the
+    same origin url.
+    """
+    assert os.path.isabs(localpath)
+
+    if os.path.exists(os.path.join(localpath, 'config')):
+        try:
+            if Repo(localpath).get_remote_url() == url:
+                return False
+        except subprocess.CalledProcessError:
+            pass
+
+    assert not os.path.exists(localpath) or not os.listdir(localpath)
+
+    tmp_path = localpath.rstrip(os.path.sep) + '.gickup-tmp'
+    if os.path.exists(tmp_path):
+        import shutil
+        shutil.rmtree(tmp_path)
+
+    for d in ['objects/info', 'objects/pack', 'refs/heads', 'refs/tags']:
+        os.makedirs(os.path.join(tmp_path, d))
+
+    with open(os.path.join(tmp_path, 'HEAD'), 'w') as f:
+        f.write('ref: refs/heads/master\n')
+
+    with open(os.path.join(tmp_path, 'config'), 'w') as f:
+        f.write('[core]\n'
+                '\trepositoryformatversion = 0\n'
+                '\tfilemode = true\n'
+                '\tbare = true\n'
+                '[remote "origin"]\n'
+                '\turl = "{}"\n'
+                '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'.format(
+                    url.replace('\\', '\\\\').replace('"', '\\"')))
+
+    # renaming onto an empty directory is fine
+    os.rename(tmp_path, localpath)
+    return True
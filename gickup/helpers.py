@@ -19,16 +19,46 @@ import subprocess
 import sys
 import os
 import json
+import copy
+import collections
 
 #DEFAULT_HOME_DIR = os.path.join(os.path.expanduser('~'), '.gickup')
 DEFAULT_SETTINGS = {
-    'settings_version': 1,
-    'repos': {},
+    'settings_version': 2,
+    'registry': None,
+    'registry_journal_mode': 'delete',
     'localbasepath': None,
     'repo_indices': [
         # ('uri_type', 'target'),
     ],
     'dateformat': '%Y-%m-%d/%H-%M-%S',
+    'snapshot_mode': 'full',
+    'retention': {
+        'hourly_days': 2,
+        'daily_days': 30,
+        'monthly_days': None,
+    },
+    'throttle': {
+        'bwlimit': None,
+        'host_bwlimit': None,
+        'nice': None,
+        'ionice': None,
+        'slow_host': None,
+    },
+    'maintenance': {
+        'max_packs': 10,
+        'max_loose_objects': 1000,
+    },
+    'fetch_policies': [
+        # {'match': 'url glob', 'branches': [...], 'depth': ..., ...},
+    ],
+    'github_api_url': 'https://api.github.com',
+    'github_token': None,
+    'index_ttl': 0,
+    'webhook_secret': None,
+    'nodes': {
+        # 'name': {'weight': 1, 'localbasepath': None},
+    },
 }
 
 
@@ -37,13 +67,84 @@ def savesettings(settings_file_path, settings):
         print('Creating settings file `{}`.'.format(settings_file_path))
     if not os.path.exists(os.path.dirname(settings_file_path)):
         os.makedirs(os.path.dirname(settings_file_path))
-    with open(settings_file_path, 'w') as f:
+
+    # repos are kept in the registry
+    settings = {k: v for k, v in settings.items() if k != 'repos'}
+
+    tmp_path = settings_file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
         json.dump(settings, f, sort_keys=True, indent=4, separators=(',', ': '))
+    os.replace(tmp_path, settings_file_path)
 
 
 def loadsettings(settings_file_path):
     with open(settings_file_path, 'r') as f:
-        return json.load(f)
+        settings = json.load(f)
+
+    # fill in settings added after the file was written
+    for k, v in DEFAULT_SETTINGS.items():
+        settings.setdefault(k, copy.deepcopy(v))
+
+    return settings
+
+
+def openregistry(settings_file_path, settings):
+    """
+    Open the repo registry configured in `settings`, by default a database
+    next to the settings file.
+
+    Settings files of version 1 keep their repos in the `repos` key. These
+    are moved into the registry and the settings file is rewritten as
+    version 2, keeping a copy of the original file.
+    """
+    from . import registry
+
+    path = settings['registry']
+    if path is None:
+        path = get_state_file_path(settings_file_path, 'db')
+    reg = registry.Registry(os.path.expanduser(path), settings['registry_journal_mode'])
+
+    repos = settings.get('repos')
+    if isinstance(repos, dict):
+        if os.path.exists(settings_file_path):
+            print('Migrating {} repos from `{}` to `{}`.'.format(len(repos), settings_file_path, reg.path))
+            import shutil
+            shutil.copyfile(settings_file_path, settings_file_path + '.v1')
+        reg.update(repos)
+        settings['settings_version'] = 2
+        if os.path.exists(settings_file_path):
+            savesettings(settings_file_path, settings)
+
+    return reg
+
+def get_state_file_path(settings_file_path, name, node=None):
+    """
+    Return the path of a state file kept next to the settings file. Nodes
+    sharing the settings file (see `sharding`) keep their own state files.
+    """
+    if node is not None:
+        name = '{}-{}'.format(name, node)
+    return '{}.{}'.format(settings_file_path, name)
+
+
+def loadstate(state_file_path, default=None):
+    try:
+        with open(state_file_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def savestate(state_file_path, state):
+    # write to a temporary file first, so an interrupted run does not leave a
+    # truncated state file behind
+    state_dir = os.path.dirname(state_file_path)
+    if state_dir and not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    tmp_path = state_file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmp_path, state_file_path)
 
 
 def makelocaldir(localbasepath):
@@ -77,6 +178,69 @@ def get_config_file_candidates():
     return [os.path.expanduser(i) for i in l]
 
 
+def run_parallel(func, items, jobs=1, key=None, key_limit=None):
+    """
+    Call `func` on all `items` using a pool of `jobs` threads.
+
+    If `key` is given, at most `key_limit` items sharing the same `key(item)`
+    are processed at the same time, except for items with a None key. Items
+    are started in the given order, as far as these limits permit.
+
+    Yields `(item, result, exception)` tuples in order of completion.
+    Exceptions raised by `func` are returned, not raised.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if key_limit is not None and key_limit < 1:
+        raise ValueError('key_limit must be at least 1')
+
+    jobs = max(1, jobs)
+    queues = collections.OrderedDict()
+    for item in items:
+        k = key(item) if key is not None else None
+        queues.setdefault(k, collections.deque()).append(item)
+
+    running = {}
+    active = collections.Counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while queues or running:
+
+            # start as many items as the limits allow
+            for k in list(queues):
+                q = queues[k]
+                while q and len(running) < jobs and (key_limit is None or k is None or active[k] < key_limit):
+                    item = q.popleft()
+                    active[k] += 1
+                    running[executor.submit(func, item)] = (item, k)
+                if not q:
+                    del queues[k]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, k = running.pop(future)
+                active[k] -= 1
+                exc = future.exception()
+                yield item, None if exc else future.result(), exc
+
+
+def format_error(exc):
+    """
+    Describe an exception in one line, including the last line of error
+    output of failed subprocesses.
+    """
+    msg = str(exc)
+    stderr = getattr(exc, 'stderr', None)
+    if stderr:
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode(errors='replace')
+        lines = [l.rsplit('\r', 1)[-1].strip() for l in stderr.splitlines()]
+        lines = [l for l in lines if l]
+        if lines:
+            msg += ' ({})'.format(lines[-1])
+    return msg
+
+
 def query_yes_no(question, default="yes"):
     """
     Ask a yes/no question via raw_input() and return their answer.
@@ -0,0 +1,116 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import uuid
+import fcntl
+from datetime import datetime
+
+
+class RunJournal(object):
+    """
+    Records the progress of a backup run, so an interrupted run can be
+    resumed with the same snapshot date: a JSON header with the run id and
+    date, followed by the path of every finished repo, one per line.
+    """
+
+    def __init__(self, path, run_id, date, finished=None, complete=False):
+        self.path = path
+        self.run_id = run_id
+        self.date = date
+        self.finished = set(finished or [])
+        self.complete = complete
+        self._file = None
+
+    @classmethod
+    def start(cls, path):
+        """
+        Begin a new run, replacing any previous journal.
+        """
+        journal = cls(path, uuid.uuid4().hex[:12], datetime.now())
+        journal._write()
+        return journal
+
+    def _write(self):
+        header = json.dumps({'run_id': self.run_id, 'date': self.date.isoformat(), 'complete': self.complete})
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(header + '\n')
+            for path in sorted(self.finished):
+                f.write(path + '\n')
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the journal of the last unfinished run, or None.
+        """
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as f:
+            lines = f.read().split('\n')
+
+        header = json.loads(lines[0])
+        # the last line is incomplete if writing it was interrupted
+        finished = [l for l in lines[1:-1] if l]
+        return cls(path, header['run_id'], datetime.fromisoformat(header['date']), finished, header.get('complete', False))
+
+    def add(self, path):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(path + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.finished.add(path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def mark_complete(self):
+        """
+        Record that the run went through all repos, leaving only failed ones.
+        """
+        self.close()
+        self.complete = True
+        self._write()
+
+    def remove(self):
+        """
+        Delete the journal of a completed run.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def lock(path):
+    """
+    Lock the journal at `path` against other runs, until the returned file
+    is closed or the process exits. Returns None if another run holds it.
+    """
+    f = open(path + '.lock', 'w')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
@@ -0,0 +1,104 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import time
+
+from . import telemetry
+
+
+def get_objects_size(git_dir):
+    """
+    Return the size in bytes of all files in the objects directory.
+    """
+    size = 0
+    for root, dirs, files in os.walk(os.path.join(git_dir, 'objects')):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def plan_maintenance(repo, stats, max_packs=10, max_loose_objects=1000):
+    """
+    Decide which maintenance tasks a repo needs, given its `count_objects`
+    statistics: a geometric `repack` when there are more than `max_packs`
+    packs or `max_loose_objects` loose objects, a `multi-pack-index` for
+    packs it does not cover yet and a `commit-graph` for packs added since
+    it was written.
+    """
+    objects = os.path.join(repo.git_dir, 'objects')
+    pack_mtimes = [_mtime(p) or 0 for p in glob.glob(os.path.join(objects, 'pack', '*.pack'))]
+    newest_pack = max(pack_mtimes, default=None)
+
+    tasks = []
+    if stats['packs'] > max_packs or stats['count'] > max_loose_objects:
+        tasks.append('repack')
+    elif stats['packs'] > 1:
+        midx = _mtime(os.path.join(objects, 'pack', 'multi-pack-index'))
+        if midx is None or midx < newest_pack:
+            tasks.append('multi-pack-index')
+
+    if newest_pack is not None or 'repack' in tasks:
+        graph = _mtime(os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain'))
+        if graph is None:
+            graph = _mtime(os.path.join(objects, 'info', 'commit-graph'))
+        if graph is None or 'repack' in tasks or graph < newest_pack:
+            tasks.append('commit-graph')
+
+    return tasks
+
+
+def maintain_repo(repo, dry_run=False, **thresholds):
+    """
+    Run the maintenance tasks `repo` needs (see `plan_maintenance`).
+
+    Repacks only use local objects (`-l`), so repos sharing a pool do not
+    keep copies of pooled objects, and never drop unreachable objects, which
+    makes them safe for pools. Returns a `telemetry.MaintenanceRecord`.
+    """
+    record = telemetry.MaintenanceRecord(repo.git_dir)
+    start = time.monotonic()
+
+    record.tasks = plan_maintenance(repo, repo.count_objects(), **thresholds)
+    if dry_run or not record.tasks:
+        record.duration = time.monotonic() - start
+        return record
+
+    record.size_before = get_objects_size(repo.git_dir)
+    try:
+        if 'repack' in record.tasks:
+            repo.repack(['-d', '-l', '--geometric=2', '--write-midx'])
+        if 'multi-pack-index' in record.tasks:
+            repo.write_multi_pack_index()
+        if 'commit-graph' in record.tasks:
+            repo.write_commit_graph()
+    finally:
+        record.size_after = get_objects_size(repo.git_dir)
+        record.duration = time.monotonic() - start
+
+    return record
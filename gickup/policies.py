@@ -0,0 +1,90 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Fetch policies limit what is backed up of a repo: dicts of `POLICY_KEYS`,
+# kept in the `fetch_policy` metadata of a repo. Branch globs may contain a
+# single `*`, which also matches slashes.
+
+import fnmatch
+
+
+POLICY_KEYS = ['branches', 'exclude_branches', 'depth', 'shallow_since', 'filter']
+
+
+def validate_policy(policy):
+    for key in policy:
+        if not key in POLICY_KEYS:
+            raise ValueError('Unknown fetch policy key "{}"'.format(key))
+    for glob in (policy.get('branches') or []) + (policy.get('exclude_branches') or []):
+        if glob.count('*') > 1:
+            raise ValueError('Branch glob "{}" may contain only one "*"'.format(glob))
+    if policy.get('depth') is not None and int(policy['depth']) < 1:
+        raise ValueError('Fetch depth must be at least 1')
+    return policy
+
+
+def get_policy_for_url(settings, url):
+    """
+    Return the policy of the first entry in the `fetch_policies` setting
+    whose `match` glob matches `url`, or None.
+    """
+    for entry in settings['fetch_policies']:
+        if fnmatch.fnmatchcase(url, entry['match']):
+            return validate_policy({k: v for k, v in entry.items() if k != 'match'})
+    return None
+
+
+def get_refspecs(policy, dst_prefix, force=False):
+    """
+    Return refspecs fetching the branches selected by `policy` to refs below
+    `dst_prefix`.
+    """
+    policy = policy or {}
+    plus = '+' if force else ''
+    refspecs = ['{}refs/heads/{}:{}{}'.format(plus, b, dst_prefix, b) for b in policy.get('branches') or ['*']]
+    # negative refspecs need git 2.29
+    refspecs += ['^refs/heads/{}'.format(b) for b in policy.get('exclude_branches') or []]
+    return refspecs
+
+
+def get_fetch_options(policy):
+    """
+    Return the keyword arguments of `Repo.fetch` for `policy`.
+    """
+    policy = policy or {}
+    return {
+            'depth': policy.get('depth'),
+            'shallow_since': policy.get('shallow_since'),
+            'filter_spec': policy.get('filter'),
+        }
+
+
+def filter_heads(policy, heads):
+    """
+    Drop the refs of branches not selected by `policy` from a dict as
+    returned by `Repo.ls_remote`.
+    """
+    if not policy:
+        return heads
+
+    def selected(ref):
+        branch = ref[len('refs/heads/'):]
+        if not any(fnmatch.fnmatchcase(branch, g) for g in policy.get('branches') or ['*']):
+            return False
+        return not any(fnmatch.fnmatchcase(branch, g) for g in policy.get('exclude_branches') or [])
+
+    return {ref: sha for ref, sha in heads.items() if selected(ref)}
@@ -0,0 +1,101 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Object pools shared by related repos (forks, mirrors).
+#
+# A pool is a bare repo listed in the `objects/info/alternates` of its
+# members. New objects of a member are copied into the pool after each fetch,
+# so the other members do not fetch them again. Members may reference objects
+# only the pool holds, so a pool must never prune.
+
+import os
+import re
+import glob
+import hashlib
+
+from . import gblib
+
+
+POOL_DIR = '.pools'
+
+
+def get_pool_name(url):
+    """
+    Derive a pool name from a repo url: forks and mirrors usually share the
+    repo's base name.
+    """
+    name = re.split(r'[/:]', url.rstrip('/'))[-1]
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+    return name
+
+
+def get_pool_path(settings, name):
+    if not name or '/' in name or name.startswith('.'):
+        raise ValueError('Invalid pool name "{}"'.format(name))
+    return os.path.join(settings['localbasepath'], POOL_DIR, name + '.git')
+
+
+def init_pool(pool_path):
+    if os.path.exists(os.path.join(pool_path, 'objects')):
+        return
+    pool = gblib.Repo(pool_path)
+    pool.init(bare=True)
+    pool.set_config('gc.auto', '0')
+    pool.set_config('gc.pruneExpire', 'never')
+    pool.set_config('core.logAllRefUpdates', 'false')
+
+
+def join_pool(repo, pool_path):
+    """
+    Make `repo` use the objects of the pool and move the objects it already
+    has into the pool.
+    """
+    init_pool(pool_path)
+
+    alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+    pool_objects = os.path.join(pool_path, 'objects')
+
+    lines = []
+    if os.path.exists(alternates):
+        with open(alternates, 'r') as f:
+            lines = f.read().splitlines()
+    if not pool_objects in lines:
+        if not os.path.exists(os.path.dirname(alternates)):
+            os.makedirs(os.path.dirname(alternates))
+        with open(alternates, 'a') as f:
+            f.write(pool_objects + '\n')
+
+    update_pool(repo, pool_path)
+
+    # drop local copies of objects the pool has now
+    repo.repack(['-a', '-d', '-l'])
+
+
+def update_pool(repo, pool_path):
+    """
+    Copy new objects of a member into the pool, keeping refs to the member's
+    current branches so fetches can use them as known commits.
+    """
+    member_id = hashlib.sha1(os.path.abspath(repo.git_dir).encode()).hexdigest()[:12]
+    pool = gblib.Repo(pool_path)
+    pool.command_prefix = repo.command_prefix
+    pool.fetch(refspec='+refs/remotes/origin/*:refs/members/{}/*'.format(member_id), remote=os.path.abspath(repo.git_dir), quiet=True)
+
+
+def list_pools(settings):
+    return sorted(glob.glob(os.path.join(settings['localbasepath'], POOL_DIR, '*.git')))
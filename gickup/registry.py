@@ -0,0 +1,169 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import sqlite3
+import threading
+import collections.abc
+
+
+class Registry(collections.abc.MutableMapping):
+    """
+    The configured repos, mapping repo urls to local backup paths, stored in
+    an SQLite database. Additionally a dict of metadata (last fetch time,
+    status, ...) is kept per repo.
+
+    `journal_mode` is the SQLite journal mode, `wal` only works on one host.
+    """
+
+    def __init__(self, path, journal_mode='delete'):
+        self.path = path
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # the connection is shared by worker threads, serialized by the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._conn:
+            # WAL keeps its index in shared memory, which does not work for
+            # several hosts using the database on a network filesystem
+            self._conn.execute('PRAGMA journal_mode={}'.format(journal_mode))
+            self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS repos ('
+                    '  url TEXT PRIMARY KEY,'
+                    '  path TEXT NOT NULL,'
+                    '  meta TEXT NOT NULL DEFAULT \'{}\''
+                    ')')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS repos_path ON repos (path)')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    def __getitem__(self, url):
+        rows = self._query('SELECT path FROM repos WHERE url = ?', (url,))
+        if not rows:
+            raise KeyError(url)
+        return rows[0][0]
+
+    def __setitem__(self, url, path):
+        self._execute(
+                'INSERT INTO repos (url, path) VALUES (?, ?) '
+                'ON CONFLICT (url) DO UPDATE SET path = excluded.path',
+                (url, path))
+
+    def __delitem__(self, url):
+        if self._execute('DELETE FROM repos WHERE url = ?', (url,)) == 0:
+            raise KeyError(url)
+
+    def __contains__(self, url):
+        return bool(self._query('SELECT 1 FROM repos WHERE url = ?', (url,)))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM repos')[0][0]
+
+    # The mixin versions of these would run one query per repo.
+
+    def keys(self):
+        return [url for url, in self._query('SELECT url FROM repos ORDER BY url')]
+
+    def values(self):
+        return [path for path, in self._query('SELECT path FROM repos ORDER BY url')]
+
+    def items(self):
+        return self._query('SELECT url, path FROM repos ORDER BY url')
+
+    def update(self, repos):
+        """
+        Add or update many repos in a single transaction.
+        """
+        if isinstance(repos, collections.abc.Mapping):
+            repos = repos.items()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                    'INSERT INTO repos (url, path) VALUES (?, ?) '
+                    'ON CONFLICT (url) DO UPDATE SET path = excluded.path',
+                    list(repos))
+
+    def update_with_meta(self, repos):
+        """
+        Add or update many repos from `(url, path, meta)` tuples in a single
+        transaction, replacing their metadata.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                    'INSERT INTO repos (url, path, meta) VALUES (?, ?, ?) '
+                    'ON CONFLICT (url) DO UPDATE SET path = excluded.path, meta = excluded.meta',
+                    [(url, path, json.dumps(meta)) for url, path, meta in repos])
+
+    def items_with_meta(self):
+        """
+        Return `(url, path, meta)` tuples of all repos.
+        """
+        return [(url, path, json.loads(meta)) for url, path, meta in self._query('SELECT url, path, meta FROM repos ORDER BY url')]
+
+    def find_by_path(self, path):
+        """
+        Return the urls of all repos backed up to `path`.
+        """
+        return [url for url, in self._query('SELECT url FROM repos WHERE path = ?', (path,))]
+
+    def rename(self, url, new_url):
+        """
+        Change the url of a repo, keeping its path and metadata.
+        """
+        if new_url in self:
+            raise ValueError('Repo {} already exists'.format(new_url))
+        if self._execute('UPDATE repos SET url = ? WHERE url = ?', (new_url, url)) == 0:
+            raise KeyError(url)
+
+    def get_meta(self, url):
+        rows = self._query('SELECT meta FROM repos WHERE url = ?', (url,))
+        if not rows:
+            raise KeyError(url)
+        return json.loads(rows[0][0])
+
+    def update_meta(self, url, **values):
+        """
+        Set the given metadata values of a repo, keeping all others. A value
+        of None removes the key.
+        """
+        with self._lock, self._conn:
+            rows = self._conn.execute('SELECT meta FROM repos WHERE url = ?', (url,)).fetchall()
+            if not rows:
+                raise KeyError(url)
+            meta = json.loads(rows[0][0])
+            for k, v in values.items():
+                if v is None:
+                    meta.pop(k, None)
+                else:
+                    meta[k] = v
+            self._conn.execute('UPDATE repos SET meta = ? WHERE url = ?', (json.dumps(meta, sort_keys=True), url))
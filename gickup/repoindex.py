@@ -16,13 +16,28 @@
 # along with Gickup. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import json
+import shlex
 import subprocess
-import urllib.request
+import threading
+import time
 
 from . import gblib
 
 
+def quote_server_path(path):
+    """
+    Quote `path` for a remote shell, leaving a leading `~` or `~user`
+    unquoted so the shell expands it.
+    """
+    match = re.match(r'~[\w.-]*(?=/|$)', path)
+    if match is None:
+        return shlex.quote(path)
+    rest = path[match.end():]
+    return match.group(0) + ('/' + shlex.quote(rest[1:]) if rest else '')
+
+
 def register_type(type_str):
     def internal(cls):
         cls.uri_type = type_str
@@ -36,12 +51,25 @@ class RepoIndex(object):
 
     uri_type = None
 
+    # dict persisted between runs, for the index to keep state in
+    cache = None
+
+    # seconds after which get_list gives up, unlimited if None
+    timeout = None
+
     def __init__(self, url):
         self.url = url
 
     def get_list(self, settings):
         raise NotImplementedError('Abstract method')
 
+    def get_repo_ids(self):
+        """
+        Return a dict of the urls of the last listing to ids that stay the
+        same when a repo is renamed or moved, as far as the index knows them.
+        """
+        return {}
+
     def get_settings_tuple(self):
         return (self.uri_type, self.url)
 
@@ -67,6 +95,12 @@ class RepoIndex(object):
 @register_type('ssh')
 class RepoIndexSSH(RepoIndex):
 
+    # ssh command line (as a list) used to reach the server
+    ssh_command = ['ssh']
+
+    # maximum depth of repos below the base path, unlimited if None
+    max_depth = None
+
     def __init__(self, url):
         super(RepoIndexSSH, self).__init__(url)
         self.serveraddress, self.serverbasepath = url.split(':', 1)
@@ -75,30 +109,180 @@ class RepoIndexSSH(RepoIndex):
 
         newrepos = {}
 
-        dirlist = subprocess.check_output(['ssh', self.serveraddress, 'find', self.serverbasepath, '-type', 'd']).decode()
-        for line in dirlist.splitlines():
-            if line.endswith('/objects'):
+        # Repos are the directories with a `HEAD` file and an `objects`
+        # directory, so only these are printed. `objects` directories are not
+        # descended into, and `*.git` directories only one level deep, so the
+        # server does not walk the (many) object, ref and log subdirectories
+        # of every repo it finds.
+        # the base path as expanded by the shell comes first
+        base = quote_server_path(self.serverbasepath)
+        l = ['printf', shlex.quote('%s\\n'), base, ';', 'find', base]
+        if self.max_depth is not None:
+            l += ['-maxdepth', str(self.max_depth + 1)]
+        l += [shlex.quote(a) for a in [
+                '(', '-path', '*.git/*', '(', '-name', 'HEAD', '-o', '-name', 'objects', ')', '-print', '-prune', ')',
+                '-o', '(', '-path', '*.git/*', '-prune', ')',
+                '-o', '(', '-type', 'd', '-name', 'objects', '-print', '-prune', ')',
+                '-o', '(', '-type', 'f', '-name', 'HEAD', '-print', ')',
+            ]]
+
+        p = subprocess.Popen(self.ssh_command + [self.serveraddress] + l, stdout=subprocess.PIPE)
+
+        # reading the output blocks, so a timer kills a hanging ssh
+        timer = None
+        timed_out = threading.Event()
+        if self.timeout is not None:
+            def kill():
+                timed_out.set()
+                p.kill()
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+
+        heads = set()
+        objects = []
+        with p.stdout:
+            basepath = p.stdout.readline().decode().rstrip('\n').rstrip('/')
+            for line in p.stdout:
+                serverpath, _, name = line.decode().rstrip('\n').rpartition('/')
+                if name == 'HEAD':
+                    heads.add(serverpath)
+                elif name == 'objects':
+                    objects.append(serverpath)
+
+        for serverpath in objects:
+            if serverpath in heads:
                 # got a repo, calculate url, localpath, check if exists
-                serverpath = line[:-len('/objects')]
                 url = '{}:{}'.format(self.serveraddress, serverpath)
-                localpath = os.path.join(settings['localbasepath'], self.serveraddress, serverpath[len(self.serverbasepath)+1:])
+                localpath = os.path.join(settings['localbasepath'], self.serveraddress, serverpath[len(basepath)+1:])
                 newrepos[url] = localpath
 
+        p.wait()
+        if timer is not None:
+            timer.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(p.args, self.timeout)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
         return newrepos
 
 @register_type('github')
 class RepoIndexGithub(RepoIndex):
 
+    # pages of the last listing
+    _pages = []
+
     def get_list(self, settings):
+        # only needed here, and slow to import
+        import urllib.error
+        import urllib.parse
+        import urllib.request
 
         newrepos = {}
         username = self.url
 
-        response = urllib.request.urlopen('https://api.github.com/users/{}/repos'.format(username))
-        data = response.read().decode()
-        repos = json.loads(data)
-        for repo in repos:
-            localpath = os.path.join(settings['localbasepath'], 'github.com', username, repo['name'])
-            newrepos[repo['git_url']] = localpath
+        # Pages of the last listing are kept with their ETag, so unchanged
+        # pages can be requested conditionally and come back as 304.
+        cached_pages = self.cache.get('pages', []) if self.cache is not None else []
+        pages = []
+
+        url = '{}/users/{}/repos?per_page=100'.format(
+                settings['github_api_url'].rstrip('/'),
+                urllib.parse.quote(username))
+
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        while url is not None:
+            timeout = None
+            if self.timeout is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError('Timed out listing repos of github user {}'.format(username))
+
+            cached = None
+            if len(cached_pages) > len(pages) and cached_pages[len(pages)]['url'] == url:
+                cached = cached_pages[len(pages)]
+
+            request = urllib.request.Request(url, headers=self._get_headers(settings, cached))
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    repos = json.loads(response.read().decode())
+                    page = {
+                        'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'next': _get_next_link(response.headers.get('Link')),
+                        'repos': [{'id': r['id'], 'name': r['name'], 'git_url': r['git_url']} for r in repos],
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code != 304 or cached is None:
+                    raise
+                page = cached
+
+            pages.append(page)
+            url = page['next']
+
+        if self.cache is not None:
+            self.cache['pages'] = pages
+        self._pages = pages
+
+        for page in pages:
+            for repo in page['repos']:
+                localpath = os.path.join(settings['localbasepath'], 'github.com', username, repo['name'])
+                newrepos[repo['git_url']] = localpath
 
         return newrepos
+
+    def get_repo_ids(self):
+        # pages cached before ids were kept lack them
+        return {r['git_url']: r['id'] for page in self._pages for r in page['repos'] if 'id' in r}
+
+    def _get_headers(self, settings, cached_page):
+        headers = {'Accept': 'application/vnd.github+json'}
+
+        token = settings['github_token'] or os.environ.get('GITHUB_TOKEN')
+        if token:
+            headers['Authorization'] = 'token {}'.format(token)
+
+        if cached_page is not None and cached_page['etag']:
+            headers['If-None-Match'] = cached_page['etag']
+
+        return headers
+
+
+def update_listing(ri, repos, now):
+    """
+    Keep the listing `repos` of index `ri` in its cache, and return what
+    changed since the last one: dicts of new and removed repos (urls to
+    local paths) and of moved repos (old to new urls).
+    """
+    old = ri.cache.get('listing')
+    old_ids = ri.cache.get('ids', {})
+    ids = ri.get_repo_ids()
+    ri.cache.update(listing=repos, ids=ids, checked=now)
+
+    if old is None:
+        return dict(repos), {}, {}
+
+    new = {url: path for url, path in repos.items() if not url in old}
+    removed = {url: path for url, path in old.items() if not url in repos}
+
+    # a removed and a new url with the same id is a renamed repo
+    removed_by_id = {old_ids[url]: url for url in removed if url in old_ids}
+    moved = {}
+    for url in sorted(new):
+        old_url = removed_by_id.pop(ids.get(url), None)
+        if old_url is not None:
+            moved[old_url] = url
+            del new[url]
+            del removed[old_url]
+
+    return new, removed, moved
+
+
+def _get_next_link(link_header):
+    # <https://...?page=2>; rel="next", <https://...?page=5>; rel="last"
+    if link_header is None:
+        return None
+    match = re.search(r'<([^>]*)>;\s*rel="next"', link_header)
+    return match.group(1) if match else None
@@ -0,0 +1,140 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Splitting the backups between several nodes sharing one registry.
+#
+# Repos are ranked against the nodes of the `nodes` setting by weighted
+# rendezvous hashing of their url, so adding or removing a node only moves
+# its share of the repos. The assignment is kept in the `node` metadata of
+# each repo, repos without one go to their first ranked node.
+
+import os
+import math
+import hashlib
+import statistics
+
+
+def get_hash_fraction(node, url):
+    """
+    Return a pseudo random number in (0, 1), fixed for `node` and `url`.
+    """
+    digest = hashlib.sha1('{}\0{}'.format(node, url).encode('utf-8')).digest()
+    return (int.from_bytes(digest[:8], 'big') + 1) / (2 ** 64 + 2)
+
+
+def rank_nodes(url, nodes):
+    """
+    Return the names of `nodes` in order of preference for `url`, nodes with
+    a higher `weight` coming first for proportionally more urls.
+    """
+    def score(name):
+        return -nodes[name].get('weight', 1) / math.log(get_hash_fraction(name, url))
+    return sorted(nodes, key=lambda name: (-score(name), name))
+
+
+def get_assigned_node(url, meta, nodes):
+    if meta.get('node') in nodes:
+        return meta['node']
+    return rank_nodes(url, nodes)[0]
+
+
+def get_node_path(settings, node, path):
+    """
+    Return where the repo registered with `path` is kept on `node`: moved to
+    the node's `localbasepath` if it has one and `path` is inside the common
+    `localbasepath`.
+    """
+    base = settings['nodes'][node].get('localbasepath')
+    if base is None:
+        return path
+    relpath = os.path.relpath(path, settings['localbasepath'])
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.path.sep):
+        return path
+    return os.path.join(os.path.expanduser(base), relpath)
+
+
+def get_registered_path(settings, node, path):
+    """
+    The reverse of `get_node_path`.
+    """
+    base = settings['nodes'][node].get('localbasepath')
+    if base is None:
+        return path
+    relpath = os.path.relpath(path, os.path.expanduser(base))
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.path.sep):
+        return path
+    return os.path.join(settings['localbasepath'], relpath)
+
+
+def select_repo(settings, node, url, path, meta):
+    """
+    Return the path of a repo on `node` if the repo is assigned to it, None
+    otherwise.
+    """
+    if get_assigned_node(url, meta, settings['nodes']) != node:
+        return None
+    return get_node_path(settings, node, path)
+
+
+def get_node_repos(settings, node):
+    """
+    Return `(url, path)` tuples of all repos assigned to `node`, with the
+    paths on that node.
+    """
+    repos = []
+    for url, path, meta in settings['repos'].items_with_meta():
+        path = select_repo(settings, node, url, path, meta)
+        if path is not None:
+            repos.append((url, path))
+    return repos
+
+
+def get_costs(items):
+    """
+    Return a dict of repo urls to their cost, the duration of their last
+    fetch, from `(url, path, meta)` tuples. Repos never fetched get the
+    median cost.
+    """
+    known = {url: meta['last_duration'] for url, path, meta in items if meta.get('last_duration') is not None}
+    default = statistics.median(known.values()) if known else 1
+    return {url: max(known.get(url, default), 0.001) for url, path, meta in items}
+
+
+def plan_assignment(costs, nodes, slack=0.25):
+    """
+    Assign repos to nodes, given a dict of their urls and costs, each to its
+    first ranked node with room left: at most `1 + slack` times its share
+    (by weight) of the total cost. Returns a dict of urls to node names.
+    """
+    total_weight = sum(n.get('weight', 1) for n in nodes.values())
+    total_cost = sum(costs.values())
+    capacity = {name: (1 + slack) * total_cost * n.get('weight', 1) / total_weight for name, n in nodes.items()}
+    load = {name: 0 for name in nodes}
+
+    assignment = {}
+    for url in sorted(costs, key=lambda u: (get_hash_fraction('', u), u)):
+        ranked = rank_nodes(url, nodes)
+        for name in ranked:
+            if load[name] + costs[url] <= capacity[name]:
+                break
+        else:
+            # too big for any node's remaining room
+            name = min(ranked, key=lambda name: load[name] / capacity[name])
+        assignment[url] = name
+        load[name] += costs[url]
+
+    return assignment
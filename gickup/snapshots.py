@@ -0,0 +1,490 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import collections
+import subprocess
+from datetime import datetime, timedelta
+
+from . import policies
+
+
+BACKUP_REF_PREFIX = 'refs/heads/backup/'
+
+# mirror of the remote branches, fetched into by `backup_changed`
+STAGING_REF_PREFIX = 'refs/gickup/staging/'
+
+# branch heads recorded by the latest snapshot of `backup_changed`
+LATEST_REF_PREFIX = 'refs/gickup/latest/'
+
+NULL_SHA = '0' * 40
+
+
+def get_backup_refspecs(date, dateformat, policy=None):
+    return policies.get_refspecs(policy, '{}{}/'.format(BACKUP_REF_PREFIX, date.strftime(dateformat)))
+
+
+def parse_backup_ref(refname, dateformat):
+    """
+    Split a backup ref into its snapshot date and branch name.
+
+    Returns `(date, branch)`, or None if `refname` is not a backup ref
+    matching `dateformat`.
+    """
+    if not refname.startswith(BACKUP_REF_PREFIX):
+        return None
+
+    # the formatted date may itself contain slashes
+    n = dateformat.count('/') + 1
+    parts = refname[len(BACKUP_REF_PREFIX):].split('/', n)
+    if len(parts) <= n:
+        return None
+
+    try:
+        date = datetime.strptime('/'.join(parts[:n]), dateformat)
+    except ValueError:
+        return None
+
+    return date, parts[n]
+
+
+def get_expired_refs(refs, dateformat, now, hourly_days=2, daily_days=30, monthly_days=None):
+    """
+    Select the backup refs to delete, out of `(refname, sha)` tuples: per
+    branch, the latest backup of each hour is kept for `hourly_days`, of
+    each day for `daily_days` and of each month for `monthly_days` (forever
+    if None), as well as the latest backup overall.
+    """
+    by_branch = collections.defaultdict(list)
+    for refname, sha in refs:
+        parsed = parse_backup_ref(refname, dateformat)
+        if parsed is not None:
+            date, branch = parsed
+            by_branch[branch].append((date, refname, sha))
+
+    expired = []
+    for backups in by_branch.values():
+        backups.sort(reverse=True)
+        seen_buckets = set()
+
+        for i, (date, refname, sha) in enumerate(backups):
+            age = now - date
+
+            if age < timedelta(days=hourly_days):
+                bucket = date.strftime('h%Y%m%d%H')
+            elif age < timedelta(days=daily_days):
+                bucket = date.strftime('d%Y%m%d')
+            elif monthly_days is None or age < timedelta(days=monthly_days):
+                bucket = date.strftime('m%Y%m')
+            else:
+                bucket = None
+
+            if i == 0 or (bucket is not None and not bucket in seen_buckets):
+                seen_buckets.add(bucket)
+            else:
+                expired.append((refname, sha))
+
+    return expired
+
+
+def prune_repo(repo, dateformat, now, dry_run=False, **retention):
+    """
+    Delete the backup refs of `repo` expired under the retention policy (see
+    `get_expired_refs`) and pack the remaining refs.
+
+    Returns a tuple of the number of deleted refs and the number of backup
+    refs before.
+    """
+    refs = repo.for_each_ref(BACKUP_REF_PREFIX)
+    expired = get_expired_refs(refs, dateformat, now, **retention)
+
+    if expired and not dry_run:
+        # the index goes first, so it never points to deleted backups
+        index = SnapshotIndex(repo.git_dir)
+        if index.exists():
+            index.remove_backups(expired, refs, dateformat)
+        repo.update_refs(['delete {} {}'.format(refname, sha) for refname, sha in expired])
+        repo.pack_refs()
+
+    return len(expired), len(refs)
+
+
+def backup_changed(repo, date, dateformat, quiet=False, policy=None):
+    """
+    Back up only the branches of `repo` (selected by the fetch `policy`)
+    that changed since its last backup, and log the changes in the snapshot
+    index. Returns a dict of the changed branches and their new commit ids
+    (None for deleted branches), and the statistics of `Repo.fetch`.
+    """
+    stats = repo.fetch(
+            refspec=policies.get_refspecs(policy, STAGING_REF_PREFIX, force=True),
+            quiet=quiet, prune=True, **policies.get_fetch_options(policy))
+
+    staging = {ref[len(STAGING_REF_PREFIX):]: sha for ref, sha in repo.for_each_ref(STAGING_REF_PREFIX)}
+    latest = {ref[len(LATEST_REF_PREFIX):]: sha for ref, sha in repo.for_each_ref(LATEST_REF_PREFIX)}
+
+    backup_commands = []
+    latest_commands = []
+    changes = {}
+
+    for branch, sha in sorted(staging.items()):
+        if latest.get(branch) != sha:
+            # a resumed run may have created the ref already
+            backup_commands.append('update {}{}/{} {}'.format(BACKUP_REF_PREFIX, date.strftime(dateformat), branch, sha))
+            latest_commands.append('update {}{} {}'.format(LATEST_REF_PREFIX, branch, sha))
+            changes[branch] = sha
+
+    for branch, sha in sorted(latest.items()):
+        if not branch in staging:
+            latest_commands.append('delete {}{} {}'.format(LATEST_REF_PREFIX, branch, sha))
+            changes[branch] = None
+
+    # the recorded heads are updated last: if interrupted before, the next
+    # backup records the same changes again instead of losing them
+    if backup_commands:
+        repo.update_refs(backup_commands)
+    if changes:
+        SnapshotIndex(repo.git_dir).append(date, changes)
+        repo.update_refs(latest_commands)
+
+    return changes, stats
+
+
+def update_latest_refs(repo, state, index=None, date=None):
+    """
+    Set the recorded branch heads of `repo` to `state`, a dict of branch
+    names and commit ids. Returns the changed branches, as `backup_changed`.
+
+    If `index` is given, the changes are appended to it at `date` before the
+    heads are updated, so an interrupted update is recorded again next time.
+    """
+    latest = {ref[len(LATEST_REF_PREFIX):]: sha for ref, sha in repo.for_each_ref(LATEST_REF_PREFIX)}
+
+    commands = []
+    changes = {}
+    for branch, sha in sorted(state.items()):
+        if latest.get(branch) != sha:
+            commands.append('update {}{} {}'.format(LATEST_REF_PREFIX, branch, sha))
+            changes[branch] = sha
+    for branch, sha in sorted(latest.items()):
+        if not branch in state:
+            commands.append('delete {}{} {}'.format(LATEST_REF_PREFIX, branch, sha))
+            changes[branch] = None
+
+    if commands:
+        if index is not None:
+            index.append(date, changes)
+        repo.update_refs(commands)
+    return changes
+
+
+def record_snapshot(repo, date, dateformat):
+    """
+    Add the changes of a full snapshot, holding all branches, to the snapshot
+    index of `repo`. An index missing so far is built from the backup refs.
+    """
+    index = SnapshotIndex(repo.git_dir)
+    if not index.exists():
+        update_latest_refs(repo, rebuild_index(repo, dateformat))
+        return
+
+    prefix = '{}{}/'.format(BACKUP_REF_PREFIX, date.strftime(dateformat))
+    state = {ref[len(prefix):]: sha for ref, sha in repo.for_each_ref(prefix)}
+    update_latest_refs(repo, state, index, date)
+
+
+def rebuild_index(repo, dateformat, full=True):
+    """
+    Write the snapshot index of `repo` anew from its backup refs, and return
+    the state of the branches at the latest snapshot. Deleted branches are
+    only detected in `full` snapshot mode.
+    """
+    snapshots = collections.defaultdict(dict)
+    for refname, sha in repo.for_each_ref(BACKUP_REF_PREFIX):
+        parsed = parse_backup_ref(refname, dateformat)
+        if parsed is not None:
+            date, branch = parsed
+            snapshots[date][branch] = sha
+
+    state = {}
+    entries = []
+    for date, heads in sorted(snapshots.items()):
+        changes = {branch: sha for branch, sha in heads.items() if state.get(branch) != sha}
+        if full:
+            changes.update((branch, None) for branch in state if not branch in heads)
+        for branch, sha in changes.items():
+            if sha is None:
+                del state[branch]
+            else:
+                state[branch] = sha
+        if changes:
+            entries.append((date, changes))
+
+    SnapshotIndex(repo.git_dir).write(entries)
+    return state
+
+
+def parse_date(value, dateformat):
+    """
+    Parse a date given as ISO 8601 (`2017-05-01`, `2017-05-01 12:00`) or in
+    the `dateformat` of backup refs.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, dateformat)
+    except ValueError:
+        raise ValueError('Invalid date "{}", expected e.g. "2017-05-01 12:00"'.format(value))
+
+
+def restore_snapshot(repo, state, dest, branch=None):
+    """
+    Restore the branches of `repo` in `state` (see `SnapshotIndex.get_state`)
+    as a git repo at `dest`, or only the files of `branch` if given.
+    """
+    if os.path.exists(dest) and (not os.path.isdir(dest) or os.listdir(dest)):
+        raise ValueError('{} exists and is not an empty directory'.format(dest))
+
+    if branch is not None:
+        if not branch in state:
+            raise ValueError('Branch {} did not exist at that time'.format(branch))
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        repo.archive(state[branch], dest)
+        return
+
+    if not state:
+        raise ValueError('No branches existed at that time')
+
+    subprocess.check_call(['git', 'init', '-q', dest])
+    # git refuses to push to the branch HEAD points to, even if it is unborn
+    subprocess.check_call(['git', '-C', dest, 'symbolic-ref', 'HEAD', 'refs/heads/gickup-restore'])
+    repo.push(os.path.abspath(dest), ['{}:refs/heads/{}'.format(sha, b) for b, sha in sorted(state.items())])
+    for default in ['master', 'main', sorted(state)[0]]:
+        if default in state:
+            subprocess.check_call(['git', '-C', dest, 'checkout', '-q', default])
+            break
+
+
+class SnapshotIndex(object):
+    """
+    Log of branch changes per snapshot, kept inside the repo: lines of
+    `<unix time> <sha> <branch>`, with a null sha for deleted branches. Lines
+    are kept in chronological order, so lookups can bisect the file.
+    """
+
+    # bytes read at once when reading the file backwards
+    block_size = 1 << 16
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, 'gickup', 'snapshots')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, date, changes):
+        timestamp = int(date.timestamp())
+        lines = [format_index_line(timestamp, sha, branch) for branch, sha in sorted(changes.items())]
+
+        last = self.get_last_time()
+        if last is not None and timestamp < last:
+            # sorted into place, after entries of the same time
+            entries = sorted(list(self.read()) + [(timestamp, sha or NULL_SHA, branch) for branch, sha in sorted(changes.items())],
+                    key=lambda entry: entry[0])
+            self._write_lines(format_index_line(*entry) for entry in entries)
+            return
+
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+
+    def write(self, entries):
+        """
+        Replace the log with `entries`, a list of `(date, changes)` tuples in
+        chronological order.
+        """
+        self._write_lines(
+                format_index_line(int(date.timestamp()), sha, branch)
+                for date, changes in entries
+                for branch, sha in sorted(changes.items()))
+
+    def _write_lines(self, lines):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+    def remove_backups(self, expired, refs, dateformat):
+        """
+        Update the log for the deletion of the backup refs `expired`, out of
+        all backup `refs`. As only changes are logged, an entry moves to the
+        oldest remaining ref of its branch with the same commit, if any.
+        """
+        expired = set(refname for refname, sha in expired)
+        kept = collections.defaultdict(list)
+        for refname, sha in refs:
+            parsed = parse_backup_ref(refname, dateformat)
+            if parsed is not None and not refname in expired:
+                kept[parsed[1]].append((parsed[0], sha))
+        for backups in kept.values():
+            backups.sort()
+
+        def get_snapshot_date(t):
+            return datetime.strptime(datetime.fromtimestamp(t).strftime(dateformat), dateformat)
+
+        timelines = collections.defaultdict(list)
+        for t, sha, branch in self.read():
+            timelines[branch].append((t, sha))
+
+        entries = []
+        for branch, timeline in timelines.items():
+            for i, (t, sha) in enumerate(timeline):
+                date = get_snapshot_date(t)
+                if sha == NULL_SHA or not '{}{}/{}'.format(BACKUP_REF_PREFIX, date.strftime(dateformat), branch) in expired:
+                    entries.append((t, sha, branch))
+                    continue
+                end = get_snapshot_date(timeline[i + 1][0]) if i + 1 < len(timeline) else None
+                for d, s in kept[branch]:
+                    if d > date and (end is None or d < end) and s == sha:
+                        entries.append((int(d.timestamp()), sha, branch))
+                        break
+
+        entries.sort(key=lambda entry: (entry[0], entry[2]))
+        self._write_lines(format_index_line(*entry) for entry in entries)
+
+    def read(self, since=None, until=None):
+        """
+        Yield the entries as `(unix time, sha, branch)` tuples, in
+        chronological order, optionally only those between the dates `since`
+        and `until`.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            end = None if until is None else self._find_end(f, until.timestamp())
+            f.seek(0 if since is None else self._find_end(f, since.timestamp(), inclusive=False))
+            while end is None or f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                yield parse_index_line(line)
+
+    def _find_end(self, f, timestamp, inclusive=True):
+        """
+        Return the offset of the first line after `timestamp` (or at it, if
+        not `inclusive`), by bisecting the file `f`.
+        """
+        def is_before(t):
+            return t <= timestamp if inclusive else t < timestamp
+
+        f.seek(0, os.SEEK_END)
+        lo, hi = 0, f.tell()
+        # the line at `lo` and any before it are before the timestamp, the one
+        # at `hi` and any after it are not
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # the first line starting at or after `mid`
+            f.seek(max(lo, mid - 1))
+            if mid > lo:
+                f.readline()
+            start = f.tell()
+            if start >= hi:
+                # no line starts in the upper half, check the lower one
+                f.seek(lo)
+                while lo < hi:
+                    line = f.readline()
+                    if not is_before(parse_index_line(line)[0]):
+                        break
+                    lo += len(line)
+                return lo
+            line = f.readline()
+            if is_before(parse_index_line(line)[0]):
+                lo = start + len(line)
+            else:
+                hi = start
+        return lo
+
+    def _read_reversed(self, f, end):
+        """
+        Yield the entries of the file `f` before offset `end`, latest first.
+        """
+        pos = end
+        rest = b''
+        while pos > 0:
+            n = min(self.block_size, pos)
+            pos -= n
+            f.seek(pos)
+            lines = (f.read(n) + rest).split(b'\n')
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield parse_index_line(line)
+        if rest:
+            yield parse_index_line(rest)
+
+    def get_last_time(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            for t, sha, branch in self._read_reversed(f, f.tell()):
+                return t
+        return None
+
+    def get_branches(self):
+        return sorted(set(branch for t, sha, branch in self.read()))
+
+    def get_commit(self, branch, date):
+        """
+        Return the commit id of `branch` as of `date`, None if it did not
+        exist then.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            # the latest entry of the branch up to `date`
+            for t, sha, b in self._read_reversed(f, self._find_end(f, date.timestamp())):
+                if b == branch:
+                    return None if sha == NULL_SHA else sha
+        return None
+
+    def get_state(self, date):
+        """
+        Return a dict of all branches and their commit ids as of `date`.
+        """
+        state = {}
+        for t, sha, branch in self.read(until=date):
+            if sha == NULL_SHA:
+                state.pop(branch, None)
+            else:
+                state[branch] = sha
+        return state
+
+
+def format_index_line(timestamp, sha, branch):
+    return '{} {} {}\n'.format(timestamp, sha or NULL_SHA, branch)
+
+
+def parse_index_line(line):
+    timestamp, sha, branch = line.decode().rstrip('\n').split(' ', 2)
+    return int(timestamp), sha, branch
@@ -0,0 +1,133 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import collections
+
+from . import gblib
+
+
+def _destination_args(address):
+    # user@domain:port -> -p port user@domain
+    host = address.rsplit('@', 1)[-1]
+    if ':' in host:
+        port = host.split(':', 1)[1]
+        return ['-p', port, address[:-len(port)-1]]
+    return [address]
+
+
+class SSHSessionPool(object):
+    """
+    Keeps one multiplexed ssh master connection per server address, so
+    consecutive ssh invocations (index scans, fetches) skip the handshake.
+    The connections are made with `ssh_command`, the one configured for git
+    by default (see `gblib.get_ssh_command`).
+    """
+
+    def __init__(self, ssh_command=None, persist=600, connect_timeout=60):
+        self.ssh_command = ssh_command
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+        self.control_dir = None
+        self.handshake_times = {}
+        self.connections = collections.Counter()
+        self._lock = threading.Lock()
+        self._address_locks = {}
+
+    def get_ssh_command(self, address):
+        """
+        Return the ssh command line (as a list) to use for a connection to
+        `address`, starting a master connection if there is none yet.
+        """
+        with self._lock:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix='gickup-ssh-')
+                if self.ssh_command is None:
+                    self.ssh_command = gblib.get_ssh_command()
+            address_lock = self._address_locks.setdefault(address, threading.Lock())
+
+        with address_lock:
+            if not address in self.handshake_times:
+                self.handshake_times[address] = self._start_master(address)
+            self.connections[address] += 1
+
+        if self.handshake_times[address] is None:
+            return list(self.ssh_command)
+        return self.ssh_command + self._get_options()
+
+    def close(self):
+        """
+        Stop all master connections and print how much handshake time was
+        saved.
+        """
+        if self.control_dir is None:
+            return
+
+        saved = 0
+        reused = 0
+        for address, seconds in self.handshake_times.items():
+            if seconds is None:
+                continue
+            reused += self.connections[address] - 1
+            saved += seconds * (self.connections[address] - 1)
+            subprocess.call(
+                    self.ssh_command + self._get_options() + ['-O', 'exit'] + _destination_args(address),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        if reused:
+            print('Reused ssh connections {} times, saved about {:.1f}s of handshakes.'.format(reused, saved))
+
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+        self.handshake_times = {}
+        self.connections.clear()
+
+    def _get_options(self):
+        return [
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}'.format(os.path.join(self.control_dir, '%C')),
+                '-o', 'ControlPersist={}'.format(self.persist),
+            ]
+
+    def _start_master(self, address):
+        # Returns the handshake duration, or None if no master could be
+        # started. The master keeps running in the background, so it must not
+        # hold on to our stdout/stderr, it logs to a file instead.
+        log_file = os.path.join(self.control_dir, address.replace('/', '_') + '.log')
+        start = time.monotonic()
+        try:
+            returncode = subprocess.call(
+                    self.ssh_command + self._get_options() + ['-E', log_file, '-N', '-f'] + _destination_args(address),
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    timeout=self.connect_timeout)
+        except subprocess.TimeoutExpired:
+            returncode = None
+        duration = time.monotonic() - start
+
+        if returncode != 0:
+            print('Could not open a shared ssh connection to {}.'.format(address))
+            if os.path.exists(log_file):
+                with open(log_file, 'r') as f:
+                    print(f.read().strip())
+                os.remove(log_file)
+            return None
+        return duration
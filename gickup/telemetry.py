@@ -0,0 +1,161 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+
+class FetchRecord(object):
+    """
+    Measurements of backing up a single repo.
+    """
+
+    def __init__(self, path, url=None):
+        self.path = path
+        self.url = url
+        self.status = None
+        self.duration = None
+        self.objects = None
+        self.bytes = None
+        self.retries = 0
+        self.exit_code = None
+        self.error = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class MaintenanceRecord(object):
+    """
+    Measurements of the maintenance of a single repo. Sizes are those of the
+    objects directory, in bytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks = []
+        self.duration = None
+        self.size_before = None
+        self.size_after = None
+        self.error = None
+
+    @property
+    def reclaimed(self):
+        if self.size_before is None or self.size_after is None:
+            return None
+        return self.size_before - self.size_after
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class VerifyRecord(object):
+    """
+    Outcome of verifying a single repo. `status` is `ok`, `corrupt` (with a
+    list of `problems`) or `error` if the check itself failed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.status = None
+        self.full = False
+        self.packs = 0
+        self.loose_objects = 0
+        self.tips = 0
+        self.problems = []
+        self.duration = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class RunReport(object):
+    """
+    Collects the fetch and maintenance records of a backup run and writes
+    them as JSON or in the Prometheus text format (e.g. for the node exporter
+    textfile collector).
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.duration = None
+        self.records = []
+        self.maintenance = []
+
+    def add(self, record):
+        if isinstance(record, MaintenanceRecord):
+            self.maintenance.append(record)
+        else:
+            self.records.append(record)
+
+    def write(self, path, report_format=None):
+        if report_format is None:
+            report_format = 'prometheus' if path.endswith('.prom') else 'json'
+
+        if report_format == 'prometheus':
+            content = self.format_prometheus()
+        else:
+            content = self.format_json()
+
+        # write atomically, the file may be picked up at any time
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def format_json(self):
+        return json.dumps({
+                'started': self.started,
+                'duration': self.duration,
+                'repos': [r.as_dict() for r in self.records],
+                'maintenance': [r.as_dict() for r in self.maintenance],
+            }, sort_keys=True, indent=4) + '\n'
+
+    def format_prometheus(self):
+        lines = []
+
+        def metric(name, metric_type, help_text, values):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in values:
+                if value is None:
+                    continue
+                label_str = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+                lines.append('{}{{{}}} {}'.format(name, label_str, value) if label_str else '{} {}'.format(name, value))
+
+        def per_repo(attr):
+            return [([('repo', r.path)], getattr(r, attr)) for r in self.records]
+
+        metric('gickup_backup_started_timestamp_seconds', 'gauge', 'Start time of the last backup run.', [([], self.started)])
+        metric('gickup_backup_duration_seconds', 'gauge', 'Duration of the last backup run.', [([], self.duration)])
+        metric('gickup_fetch_duration_seconds', 'gauge', 'Time spent backing up a repo, including retries.', per_repo('duration'))
+        metric('gickup_fetch_received_objects', 'gauge', 'Objects received while backing up a repo.', per_repo('objects'))
+        metric('gickup_fetch_received_bytes', 'gauge', 'Pack bytes received while backing up a repo.', per_repo('bytes'))
+        metric('gickup_fetch_retries', 'gauge', 'Retries needed to back up a repo.', per_repo('retries'))
+        metric('gickup_fetch_exit_code', 'gauge', 'Exit code of the last git invocation backing up a repo.', per_repo('exit_code'))
+        metric('gickup_fetch_success', 'gauge', 'Whether backing up a repo succeeded.',
+                [([('repo', r.path)], int(r.status != 'failed')) for r in self.records])
+        metric('gickup_maintenance_duration_seconds', 'gauge', 'Time spent on maintenance of a repo.',
+                [([('repo', r.path)], r.duration) for r in self.maintenance])
+        metric('gickup_maintenance_reclaimed_bytes', 'gauge', 'Disk space freed by maintenance of a repo.',
+                [([('repo', r.path)], r.reclaimed) for r in self.maintenance])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,223 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Limits on the resources used by backups.
+#
+# Run as `python throttle.py <socket> <host> -- <command...>` this module runs
+# the command (git's ssh command) and relays its output as fast as the
+# `RateLimiter` listening on `socket` allows.
+
+import os
+import sys
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+
+def parse_rate(value):
+    """
+    Parse a rate like `500k` or `10M` (bytes per second, binary units).
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    factors = {'k': 1<<10, 'm': 1<<20, 'g': 1<<30}
+    if value[-1:].lower() in factors:
+        return int(float(value[:-1]) * factors[value[-1].lower()])
+    return int(float(value))
+
+
+class TokenBucket(object):
+    """
+    A rate of `rate` bytes per second, allowing bursts of a quarter second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate // 4, 1 << 14)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        """
+        Take `n` bytes from the bucket, returning the seconds to wait before
+        using them. Waiting callers go into debt, so they are served in turn.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            return max(0, -self._tokens / self.rate)
+
+
+class _RelayHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        host = self.rfile.readline().decode().rstrip('\n')
+        for line in self.rfile:
+            self.server.limiter.take(host, int(line))
+            self.wfile.write(b'\n')
+
+
+class _RelayServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class RateLimiter(object):
+    """
+    Shares a total (`bwlimit`) and a per-host (`host_bwlimit`) download rate
+    limit, in bytes per second, between the relay processes of all fetches
+    over ssh (see `get_command`).
+    """
+
+    def __init__(self, bwlimit=None, host_bwlimit=None):
+        self.bwlimit = bwlimit
+        self.host_bwlimit = host_bwlimit
+        self.control_dir = None
+        self._total = TokenBucket(bwlimit) if bwlimit is not None else None
+        self._hosts = {}
+        self._server = None
+        self._lock = threading.Lock()
+
+    def take(self, host, n):
+        """
+        Wait until `n` more bytes may be received from `host`.
+        """
+        delays = []
+        if self._total is not None:
+            delays.append(self._total.reserve(n))
+        if self.host_bwlimit is not None:
+            with self._lock:
+                bucket = self._hosts.setdefault(host, TokenBucket(self.host_bwlimit))
+            delays.append(bucket.reserve(n))
+        delay = max(delays, default=0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_command(self, host, command):
+        """
+        Return `command` (an ssh command line, as a list) wrapped in a relay
+        limiting the rate of its output, starting the limiter if needed.
+        """
+        with self._lock:
+            if self._server is None:
+                self.control_dir = tempfile.mkdtemp(prefix='gickup-throttle-')
+                self._server = _RelayServer(os.path.join(self.control_dir, 'socket'), _RelayHandler)
+                self._server.limiter = self
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return [sys.executable, os.path.abspath(__file__), self._server.server_address, host or '', '--'] + command
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self._server = None
+
+
+def get_priority_prefix(nice=None, ionice=None):
+    """
+    Return a command prefix running a command with the given CPU (`nice`
+    level) and IO (`ionice` scheduling class) priorities.
+    """
+    prefix = []
+    if nice is not None:
+        prefix += ['nice', '-n', str(nice)]
+    if ionice is not None:
+        if shutil.which('ionice') is None:
+            print('Warning: ionice not found, ignoring IO priority.')
+        else:
+            prefix += ['ionice', '-c', str(ionice)]
+    return prefix
+
+
+class HostBackoff(object):
+    """
+    Delays requests to hosts that failed or took longer than `slow` seconds,
+    by `base` seconds doubling with every further failure up to `maximum`,
+    and halving with every success.
+    """
+
+    def __init__(self, base=5, maximum=600, slow=None):
+        self.base = base
+        self.maximum = maximum
+        self.slow = slow
+        self._delays = {}
+        self._not_before = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            not_before = self._not_before.get(host, 0)
+        delay = not_before - time.monotonic()
+        if delay > 0:
+            print('Waiting {:.0f}s before contacting {} again.'.format(delay, host))
+            time.sleep(delay)
+
+    def report(self, host, ok, duration=None):
+        if ok and self.slow is not None and duration is not None and duration > self.slow:
+            ok = False
+
+        with self._lock:
+            delay = self._delays.get(host, 0)
+            if ok:
+                delay = delay / 2 if delay > self.base else 0
+            else:
+                delay = min(self.maximum, max(self.base, delay * 2))
+            self._delays[host] = delay
+            self._not_before[host] = time.monotonic() + delay
+
+
+def relay(address, host, command):
+    """
+    Run `command`, passing its output on as fast as the `RateLimiter`
+    listening on `address` allows for `host`. Input is passed through
+    unchanged.
+    """
+    limiter = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    limiter.connect(address)
+    limiter.sendall(host.encode() + b'\n')
+    replies = limiter.makefile('rb')
+
+    p = subprocess.Popen(command, stdout=subprocess.PIPE)
+    out = sys.stdout.buffer
+
+    while True:
+        chunk = os.read(p.stdout.fileno(), 1 << 16)
+        if not chunk:
+            break
+        limiter.sendall(b'%d\n' % len(chunk))
+        if not replies.readline():
+            raise RuntimeError('Rate limiter went away')
+        out.write(chunk)
+        out.flush()
+
+    limiter.close()
+    return p.wait()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or sys.argv[3] != '--':
+        sys.exit('usage: throttle.py <socket> <host> -- <command...>')
+    sys.exit(relay(sys.argv[1], sys.argv[2], sys.argv[4:]))
@@ -0,0 +1,125 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# Integrity checks of backup repos.
+#
+# After a first full check, only new packs, loose objects written since and
+# the history up to the ref tips verified before are checked again.
+
+import os
+import glob
+import hashlib
+import subprocess
+import time
+import zlib
+
+from . import telemetry
+
+
+def verify_loose_objects(git_dir, since=None):
+    """
+    Check that loose objects (modified after `since`) hash to their ids.
+    Returns the number of objects checked and a list of problems.
+    """
+    count = 0
+    problems = []
+    for path in glob.glob(os.path.join(git_dir, 'objects', '[0-9a-f][0-9a-f]', '*')):
+        try:
+            if since is not None and os.stat(path).st_mtime < since:
+                continue
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            # packed in the meantime
+            continue
+        except zlib.error as e:
+            problems.append('corrupt loose object {}: {}'.format(path, e))
+            continue
+
+        object_id = os.path.basename(os.path.dirname(path)) + os.path.basename(path)
+        algorithm = 'sha256' if len(object_id) == 64 else 'sha1'
+        if hashlib.new(algorithm, data).hexdigest() != object_id:
+            problems.append('hash mismatch of loose object {}'.format(object_id))
+        count += 1
+    return count, problems
+
+
+def verify_repo(repo, state=None, full=False, partial=False):
+    """
+    Verify `repo`, incrementally from `state` as returned by an earlier call.
+    Returns a `telemetry.VerifyRecord` and the new state, which is only
+    advanced if no problems were found.
+    """
+    record = telemetry.VerifyRecord(repo.git_dir)
+    start = time.monotonic()
+    started = time.time()
+
+    previous = state
+    if state is None:
+        full = True
+        state = {}
+    record.full = full
+
+    try:
+        tips = sorted(set(sha for ref, sha in repo.for_each_ref('refs/')))
+        record.tips = len(tips)
+
+        if full:
+            packs = [os.path.basename(p) for p in glob.glob(os.path.join(repo.git_dir, 'objects', 'pack', '*.idx'))]
+            record.packs = len(packs)
+            record.problems = repo.fsck()
+        else:
+            verified_packs = set(state.get('packs', []))
+            packs = []
+            for idx in sorted(glob.glob(os.path.join(repo.git_dir, 'objects', 'pack', '*.idx'))):
+                packs.append(os.path.basename(idx))
+                if os.path.basename(idx) in verified_packs:
+                    continue
+                record.packs += 1
+                try:
+                    repo.verify_pack(idx)
+                except subprocess.CalledProcessError as e:
+                    record.problems.append('corrupt pack {}: {}'.format(os.path.basename(idx), e.stderr.strip()))
+
+            record.loose_objects, problems = verify_loose_objects(repo.git_dir, state.get('time'))
+            record.problems += problems
+
+            # verified tips whose refs were deleted may be gone
+            known_tips = set(state.get('tips', [])) & set(tips)
+            new_tips = [t for t in tips if not t in known_tips]
+            if new_tips:
+                try:
+                    missing = repo.find_missing_objects(new_tips, known_tips, allow_promisor=partial)
+                except subprocess.CalledProcessError as e:
+                    record.problems.append('unreadable history: {}'.format(e.stderr.strip()))
+                else:
+                    record.problems += ['missing object {}'.format(m) for m in missing]
+
+    except (subprocess.CalledProcessError, OSError) as e:
+        record.status = 'error'
+        record.problems.append(str(e))
+        record.duration = time.monotonic() - start
+        return record, previous
+
+    record.duration = time.monotonic() - start
+    if record.problems:
+        record.status = 'corrupt'
+        return record, previous
+
+    record.status = 'ok'
+    # objects written while checking are checked next time
+    return record, {'packs': packs, 'tips': tips, 'time': started}
@@ -0,0 +1,200 @@
+# Copyright (C)  2017  Philip Matura
+#
+# This file is part of Gickup.
+#
+# Gickup is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gickup is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Gickup. If not, see <http://www.gnu.org/licenses/>.
+
+# HTTP listener for push notifications, used by the daemon to back up repos
+# right after they changed. Accepts POSTs of GitHub push webhooks, JSON
+# objects with a `url` or `urls`, form fields `url` or plain text urls, one
+# per line.
+
+import os
+import hmac
+import socket
+import json
+import hashlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import gblib
+
+
+def get_url_key(url):
+    """
+    Return a `(host, path)` key identifying the repo of `url` independent of
+    the user, port, scheme and `.git` suffix used to access it.
+    """
+    uri_type, target = gblib.url_split_type_target(url)
+
+    if uri_type == 'file':
+        host = None
+        path = os.path.normpath(target)
+    else:
+        host = gblib.url_host(url)
+        if uri_type == 'ssh' and not '://' in url:
+            path = target.split(':', 1)[1] if ':' in target else ''
+        else:
+            path = target.split('/', 1)[1] if '/' in target else ''
+
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    # github paths are case insensitive, other servers rarely have repos
+    # differing only in case
+    return (host and host.lower(), path.rstrip('/').lower())
+
+
+def get_github_urls(payload):
+    repository = payload.get('repository') or {}
+    return [repository[k] for k in ['clone_url', 'ssh_url', 'git_url', 'html_url'] if repository.get(k)]
+
+
+def parse_payload(content_type, body):
+    """
+    Return the repo urls of a notification, raises ValueError for malformed
+    ones.
+    """
+    content_type = (content_type or '').split(';', 1)[0].strip().lower()
+    text = body.decode('utf-8')
+
+    if content_type == 'application/json':
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object')
+        if 'repository' in data:
+            return get_github_urls(data)
+        if 'urls' in data:
+            urls = data['urls']
+        elif 'url' in data:
+            urls = [data['url']]
+        else:
+            raise ValueError('Expected a `url` or `urls` key')
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            raise ValueError('Urls must be strings')
+        return urls
+
+    elif content_type == 'application/x-www-form-urlencoded':
+        fields = urllib.parse.parse_qs(text)
+        if 'payload' in fields:
+            return parse_payload('application/json', fields['payload'][0].encode('utf-8'))
+        return fields.get('url', [])
+
+    else:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def check_auth(secret, headers, body):
+    """
+    Requests must be signed like GitHub webhooks or carry the secret in an
+    `X-Gickup-Token` header, if a secret is configured.
+    """
+    if secret is None:
+        return True
+
+    signature = headers.get('X-Hub-Signature-256')
+    if signature is not None:
+        expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, expected)
+
+    token = headers.get('X-Gickup-Token')
+    return token is not None and hmac.compare_digest(token, secret)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._reply(400, {'error': 'invalid Content-Length'})
+            return
+        if length > self.server.max_body:
+            self.close_connection = True
+            self._reply(413, {'error': 'notification larger than {} bytes'.format(self.server.max_body)})
+            return
+        body = self.rfile.read(length)
+
+        if not check_auth(self.server.secret, self.headers, body):
+            self._reply(403, {'error': 'invalid signature or token'})
+            return
+
+        event = self.headers.get('X-GitHub-Event')
+        if event is not None and event != 'push':
+            # e.g. the `ping` sent when a webhook is created
+            self._reply(200, {'queued': []})
+            return
+
+        try:
+            urls = parse_payload(self.headers.get('Content-Type'), body)
+        except (ValueError, KeyError, UnicodeDecodeError) as e:
+            self._reply(400, {'error': 'malformed notification: {}'.format(e)})
+            return
+
+        self._reply(202, {'queued': self.server.on_push(urls)})
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8') + b'\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # queued backups are logged by the daemon
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Listens on `address` for push notifications, calling `on_push` with their
+    urls from a request thread. `on_push` returns the paths of the repos
+    queued for backup, which are sent back to the client.
+    """
+
+    daemon_threads = True
+    # github caps webhook payloads at 25 MB
+    max_body = 25 * 1024 * 1024
+
+    def __init__(self, address, on_push, secret=None):
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(address, _Handler)
+        self.on_push = on_push
+        self.secret = secret
+
+    def start(self):
+        """
+        Serve requests in a background thread, until `shutdown` is called.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_address(value):
+    """
+    Parse a `[host:]port` listen address, listening on localhost by default.
+    IPv6 hosts are given in brackets, e.g. `[::]:8080`.
+    """
+    host, _, port = value.rpartition(':')
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    elif ':' in host or '[' in host or ']' in host:
+        raise ValueError('Invalid listen address "{}", put IPv6 hosts in brackets'.format(value))
+    return (host or '127.0.0.1', int(port))
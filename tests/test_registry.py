@@ -0,0 +1,57 @@
+import json
+import sqlite3
+
+from gickup import helpers
+from gickup import registry
+
+
+def write_settings(path, settings):
+    with open(path, 'w') as f:
+        json.dump(settings, f)
+
+
+def test_migrates_v1_settings(tmp_path):
+    path = str(tmp_path / 'config.json')
+    repos = {'host:a.git': '/backup/a', 'host:b.git': '/backup/b'}
+    write_settings(path, {'localbasepath': '/backup', 'repos': repos})
+
+    settings = helpers.loadsettings(path)
+    reg = helpers.openregistry(path, settings)
+    assert dict(reg.items()) == repos
+    assert reg.path == path + '.db'
+    reg.close()
+
+    with open(path) as f:
+        saved = json.load(f)
+    assert saved['settings_version'] == 2
+    assert not 'repos' in saved
+    with open(path + '.v1') as f:
+        assert json.load(f)['repos'] == repos
+
+    # opening the migrated settings keeps the repos
+    settings = helpers.loadsettings(path)
+    assert dict(helpers.openregistry(path, settings).items()) == repos
+
+
+def test_keeps_metadata(tmp_path):
+    reg = registry.Registry(str(tmp_path / 'db'))
+    reg['host:a.git'] = '/backup/a'
+    reg.update_meta('host:a.git', last_fetch=1, status='ok')
+    reg.update_meta('host:a.git', status=None)
+    reg['host:a.git'] = '/backup/moved'
+    assert reg.get_meta('host:a.git') == {'last_fetch': 1}
+
+    other = registry.Registry(str(tmp_path / 'other'))
+    other.update_with_meta(reg.items_with_meta())
+    assert other.items_with_meta() == [('host:a.git', '/backup/moved', {'last_fetch': 1})]
+
+
+def test_leaves_wal_mode(tmp_path):
+    path = str(tmp_path / 'db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=wal')
+    conn.close()
+
+    reg = registry.Registry(path)
+    assert reg._query('PRAGMA journal_mode') == [('delete',)]
+    reg.close()
@@ -0,0 +1,93 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gickup import repoindex
+
+
+class GithubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        number = int(query.get('page', ['1'])[0])
+        pages = self.server.pages
+        repos = pages[number - 1]
+        etag = '"{}-{}"'.format(number, len(repos))
+        self.server.requests.append((number, self.headers.get('If-None-Match')))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        body = json.dumps([{'id': i, 'name': name, 'git_url': 'git://github.com/user/{}.git'.format(name)}
+                for i, name in repos]).encode()
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        if number < len(pages):
+            self.send_header('Link', '<http://127.0.0.1:{}/users/user/repos?per_page=100&page={}>; rel="next"'.format(
+                self.server.server_address[1], number + 1))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def github(monkeypatch):
+    monkeypatch.delenv('GITHUB_TOKEN', raising=False)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GithubHandler)
+    server.pages = [[(1, 'a'), (2, 'b')], [(3, 'c')]]
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_list(github, cache):
+    ri = repoindex.RepoIndexGithub('user')
+    ri.cache = cache
+    settings = {
+        'github_api_url': 'http://127.0.0.1:{}'.format(github.server_address[1]),
+        'github_token': None,
+        'localbasepath': '/backup',
+    }
+    return ri.get_list(settings), ri.get_repo_ids()
+
+
+def test_github_listing_follows_pages(github):
+    repos, ids = get_list(github, {})
+    assert sorted(repos) == ['git://github.com/user/{}.git'.format(n) for n in 'abc']
+    assert repos['git://github.com/user/c.git'] == '/backup/github.com/user/c'
+    assert ids['git://github.com/user/c.git'] == 3
+    assert github.requests == [(1, None), (2, None)]
+
+
+def test_github_listing_reuses_unchanged_pages(github):
+    cache = {}
+    first, _ = get_list(github, cache)
+    github.requests.clear()
+
+    repos, ids = get_list(github, cache)
+    assert repos == first
+    assert len(ids) == 3
+    assert github.requests == [(1, '"1-2"'), (2, '"2-1"')]
+
+
+def test_github_listing_refetches_changed_pages(github):
+    cache = {}
+    get_list(github, cache)
+    github.requests.clear()
+
+    github.pages[1].append((4, 'd'))
+    repos, _ = get_list(github, cache)
+    assert 'git://github.com/user/d.git' in repos
+    assert github.requests == [(1, '"1-2"'), (2, '"2-1"')]
+    assert cache['pages'][1]['etag'] == '"2-2"'
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import subprocess
+from datetime import datetime, timedelta
+
+from gickup import gblib
+from gickup import helpers
+from gickup import snapshots
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATEFORMAT = helpers.DEFAULT_SETTINGS['dateformat']
+
+
+def git(*args):
+    subprocess.check_call(['git'] + list(args), stdout=subprocess.DEVNULL)
+
+
+def commit(path, message):
+    git('-C', path, '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '--allow-empty', '-m', message)
+
+
+def make_backup(tmp_path):
+    src = str(tmp_path / 'src')
+    git('init', '-q', '-b', 'master', src)
+    commit(src, 'initial')
+    git('-C', src, 'branch', 'dev')
+
+    path = str(tmp_path / 'backup' / 'src')
+    gblib.create_bare_repo(src, path)
+    return src, gblib.Repo(path)
+
+
+def backup_full(repo, date):
+    repo.fetch(refspec=snapshots.get_backup_refspecs(date, DATEFORMAT), quiet=True)
+    snapshots.record_snapshot(repo, date, DATEFORMAT)
+
+
+def gickup(tmp_path, *args):
+    config = str(tmp_path / 'config.json')
+    if not os.path.exists(config):
+        with open(config, 'w') as f:
+            json.dump({'localbasepath': str(tmp_path / 'backup')}, f)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-m', 'gickup', '--config-file', config] + list(args),
+            stdout=subprocess.PIPE, env=env, check=True).stdout.decode()
+
+
+def test_prune_keeps_unchanged_branches_in_index(tmp_path):
+    src, repo = make_backup(tmp_path)
+    dev = repo.ls_remote()['refs/heads/dev']
+
+    # three backups in the same hour, with `dev` unchanged in all of them
+    first = datetime(2020, 1, 1, 12, 0)
+    dates = [first + timedelta(minutes=10 * i) for i in range(3)]
+    for date in dates:
+        commit(src, date.isoformat())
+        backup_full(repo, date)
+
+    deleted, total = snapshots.prune_repo(repo, DATEFORMAT, dates[-1])
+    assert (deleted, total) == (4, 6)
+
+    index = snapshots.SnapshotIndex(repo.git_dir)
+    assert index.get_state(dates[-1]) == {'master': repo.ls_remote()['refs/heads/master'], 'dev': dev}
+    assert index.get_commit('dev', dates[0]) is None
+
+    output = gickup(tmp_path, 'log', '--at', dates[-1].isoformat(), repo.git_dir, 'dev')
+    assert output.strip() == dev
+
+
+def test_prune_drops_entries_of_changed_branches(tmp_path):
+    src, repo = make_backup(tmp_path)
+
+    first = datetime(2020, 1, 1, 12, 0)
+    dates = [first + timedelta(minutes=10 * i) for i in range(3)]
+    for date in dates:
+        commit(src, date.isoformat())
+        backup_full(repo, date)
+
+    snapshots.prune_repo(repo, DATEFORMAT, dates[-1])
+
+    index = snapshots.SnapshotIndex(repo.git_dir)
+    assert [(sha, branch) for t, sha, branch in index.read() if branch == 'master'] == \
+            [(repo.ls_remote()['refs/heads/master'], 'master')]
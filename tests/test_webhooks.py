@@ -0,0 +1,88 @@
+import hmac
+import json
+import hashlib
+import urllib.error
+import urllib.request
+
+import pytest
+
+from gickup import webhooks
+
+
+SECRET = 's3cret'
+
+
+def sign(body, secret=SECRET):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def test_check_auth_signature():
+    body = b'{"url": "x"}'
+    assert webhooks.check_auth(SECRET, {'X-Hub-Signature-256': sign(body)}, body)
+    assert not webhooks.check_auth(SECRET, {'X-Hub-Signature-256': sign(body, 'other')}, body)
+    assert not webhooks.check_auth(SECRET, {'X-Hub-Signature-256': sign(body)}, body + b' ')
+
+
+def test_check_auth_token():
+    assert webhooks.check_auth(SECRET, {'X-Gickup-Token': SECRET}, b'')
+    assert not webhooks.check_auth(SECRET, {'X-Gickup-Token': 'other'}, b'')
+    assert not webhooks.check_auth(SECRET, {}, b'')
+    # a wrong signature is not rescued by a right token
+    assert not webhooks.check_auth(SECRET, {'X-Hub-Signature-256': 'sha256=00', 'X-Gickup-Token': SECRET}, b'')
+
+
+def test_check_auth_without_secret():
+    assert webhooks.check_auth(None, {}, b'')
+
+
+def test_parse_address():
+    assert webhooks.parse_address('8080') == ('127.0.0.1', 8080)
+    assert webhooks.parse_address('0.0.0.0:8080') == ('0.0.0.0', 8080)
+    assert webhooks.parse_address('[::]:8080') == ('::', 8080)
+    with pytest.raises(ValueError):
+        webhooks.parse_address('::1:8080')
+
+
+@pytest.fixture
+def server():
+    pushed = []
+
+    def on_push(urls):
+        pushed.extend(urls)
+        return urls
+
+    server = webhooks.WebhookServer(('127.0.0.1', 0), on_push, secret=SECRET)
+    server.pushed = pushed
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, headers):
+    request = urllib.request.Request('http://127.0.0.1:{}/'.format(server.server_address[1]), data=body, headers=headers)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_signed_github_push(server):
+    body = json.dumps({'repository': {'clone_url': 'https://github.com/u/r.git'}}).encode()
+    headers = {'Content-Type': 'application/json', 'X-GitHub-Event': 'push', 'X-Hub-Signature-256': sign(body)}
+    assert post(server, body, headers) == (202, {'queued': ['https://github.com/u/r.git']})
+    assert server.pushed == ['https://github.com/u/r.git']
+
+
+def test_rejects_bad_signature(server):
+    body = b'{"url": "host:r.git"}'
+    headers = {'Content-Type': 'application/json', 'X-Hub-Signature-256': sign(body, 'other')}
+    assert post(server, body, headers)[0] == 403
+    assert server.pushed == []
+
+
+def test_rejects_large_body(server):
+    server.max_body = 10
+    assert post(server, b'x' * 100, {'X-Gickup-Token': SECRET})[0] == 413
+    assert server.pushed == []